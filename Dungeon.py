@@ -1,8 +1,23 @@
+import time
+_STARTUP_T0 = time.perf_counter()  # 起動時間計測の基準（import より前）
+
 import os
 import sys
 import random
 import pygame as pg
 import math
+import numpy as np
+import array
+import gc
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+
+# 起動時間の区切り（区間名, 終了時刻）。最初の main() の StartupTrace が引き継ぐ
+_STARTUP_MARKS: list[tuple[str, float]] = [("imports", time.perf_counter())]
 
 WIDTH = 1100
 HEIGHT = 650
@@ -11,6 +26,26 @@ FPS = 60
 # デバッグ：地面ラインを表示するなら True
 DEBUG_DRAW_GROUND_LINE = True
 
+# 録画：ファイル名を入れると録画する（.dgcap は独自圧縮形式、.mp4/.gif などは ffmpeg へ渡す）
+CAPTURE_FILE = None
+
+# ゴースト：このランの軌跡を保存するファイル / 一緒に走らせる過去ランのファイル
+GHOST_RECORD_FILE = None
+GHOST_FILES: list[str] = []
+
+# 入力遅延：計測するなら True / 入力をなるべく遅く（シミュレーション直前に）読むなら True
+TRACK_INPUT_LATENCY = False
+LOW_LATENCY_INPUT = False
+
+# 起動時間：最初のフレームまでの内訳を表示するなら True
+TRACE_STARTUP = False
+
+# テレメトリ：ゲーム中のイベント（スポーン・撃破・取得・被弾など）を記録するファイル
+TELEMETRY_FILE = None
+
+# 計測値を HTTP で公開するポート（None なら公開しない。127.0.0.1 のみで待ち受ける）
+METRICS_PORT = None
+
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 # ステージ2へ移行するフレーム（仕様に明記が無いので仮定：25秒相当）
@@ -33,24 +68,79 @@ BOX_MARGIN = 20
 # =========================
 # クラス外関数（メモ準拠）
 # =========================
-def load_image(filename: str) -> pg.Surface:
-    """
-    画像読み込み（fig/filename -> filename の順に探す）
-    ※displayが未生成のタイミングでも落ちないようにする
-    """
+# 読み込み済み画像（ファイル名 -> Surface）。convert_alpha 済みのものだけ入れる
+_IMAGE_CACHE: dict[str, pg.Surface] = {}
+# 拡大縮小済み画像（(ファイル名, 倍率) -> Surface）
+_SCALED_CACHE: dict[tuple[str, float], pg.Surface] = {}
+# 裏で先読みした画像（未 convert）。load_image / load_scaled_image が最初に使う時に convert する
+_PREFETCHED: dict[str, pg.Surface] = {}
+_PREFETCHED_SCALED: dict[tuple[str, float], pg.Surface] = {}
+# 画像キャッシュの [hit, miss]
+_IMAGE_CACHE_STATS = [0, 0]
+
+
+def _read_image(filename: str) -> pg.Surface:
     candidates = [os.path.join("fig", filename), filename]
     last_err = None
     for path in candidates:
         try:
-            img = pg.image.load(path)
-            # 画面が作られている時だけ convert_alpha する
-            if pg.display.get_init() and pg.display.get_surface() is not None:
-                img = img.convert_alpha()
-            return img
+            return pg.image.load(path)
         except Exception as e:
             last_err = e
     raise SystemExit(f"画像 '{filename}' の読み込みに失敗しました: {last_err}")
 
+
+def load_image(filename: str) -> pg.Surface:
+    """
+    画像読み込み（fig/filename -> filename の順に探す）
+    ※displayが未生成のタイミングでも落ちないようにする
+    ※同じファイルは2回目以降キャッシュを返す（返した Surface は書き換えないこと）
+    """
+    img = _IMAGE_CACHE.get(filename)
+    if img is not None:
+        _IMAGE_CACHE_STATS[0] += 1
+        return img
+    _IMAGE_CACHE_STATS[1] += 1
+
+    img = _PREFETCHED.pop(filename, None)
+    if img is None:
+        img = _read_image(filename)
+    # 画面が作られている時だけ convert_alpha する
+    if pg.display.get_init() and pg.display.get_surface() is not None:
+        img = img.convert_alpha()
+        _IMAGE_CACHE[filename] = img
+    return img
+
+
+def load_scaled_image(filename: str, scale: float) -> pg.Surface:
+    """
+    load_image + rotozoom(scale) の結果をキャッシュして返す（スポーンごとの縮小をなくす）
+    """
+    key = (filename, scale)
+    img = _SCALED_CACHE.get(key)
+    if img is not None:
+        _IMAGE_CACHE_STATS[0] += 1
+        return img
+    img = _PREFETCHED_SCALED.pop(key, None)
+    if img is not None and pg.display.get_surface() is not None:
+        _IMAGE_CACHE_STATS[1] += 1
+        img = _SCALED_CACHE[key] = img.convert_alpha()
+        return img
+    img = load_image(filename)
+    if scale != 1.0:
+        img = pg.transform.rotozoom(img, 0, scale)
+    if filename in _IMAGE_CACHE:
+        _SCALED_CACHE[key] = img
+    return img
+
+
+def get_image_cache_stats() -> tuple[int, int]:
+    """
+    画像キャッシュの (hit, miss)
+    """
+    return _IMAGE_CACHE_STATS[0], _IMAGE_CACHE_STATS[1]
+
+
 def check_bound(obj_rct: pg.Rect) -> tuple[bool, bool]:
     yoko, tate = True, True
     if obj_rct.left < 0 or WIDTH < obj_rct.right:
@@ -117,10 +207,12 @@ def should_switch_stage(tmr: int) -> bool:
     return tmr >= STAGE2_TMR
 
 #高柳変更
-def spawn_enemy(enemies: pg.sprite.Group, stage: int) -> None:
+def spawn_enemy(enemies: pg.sprite.Group, stage: int) -> "Enemy":
     params = stage_params(stage)
     kind = random.choice(["ground", "air"])  # 地面敵 / 空中敵
-    enemies.add(Enemy(stage=stage, kind=kind, speed=params["enemy_speed"]))
+    emy = Enemy(stage=stage, kind=kind, speed=params["enemy_speed"])
+    enemies.add(emy)
+    return emy
 
 
 
@@ -129,6 +221,7 @@ def detect_ground_y(bg_scaled: pg.Surface) -> int:
     """
     リサイズ済み背景から「暗くて横方向に均一な水平ライン」を推定し、
     その“1px下”を地面Yとして返す。
+    （各行の輝度の平均・標準偏差は NumPy でまとめて計算する）
     """
     w, h = bg_scaled.get_size()
 
@@ -136,32 +229,122 @@ def detect_ground_y(bg_scaled: pg.Surface) -> int:
     y_end = int(h * 0.90)
 
     x_step = 4
-    best_y = int(h * 0.75)
-    best_score = 10**18
-
-    for y in range(y_start, y_end):
-        s = 0.0
-        s2 = 0.0
-        n = 0
-        for x in range(0, w, x_step):
-            r, g, b, a = bg_scaled.get_at((x, y))
-            lum = 0.2126 * r + 0.7152 * g + 0.0722 * b
-            s += lum
-            s2 += lum * lum
-            n += 1
-
-        mean = s / n
-        var = (s2 / n) - mean * mean
-        std = (var ** 0.5) if var > 0 else 0.0
-
-        score = mean + 0.3 * std
-        if score < best_score:
-            best_score = score
-            best_y = y
+
+    rgb = pg.surfarray.array3d(bg_scaled)[0:w:x_step, y_start:y_end].astype(np.float64)
+    lum = 0.2126 * rgb[..., 0] + 0.7152 * rgb[..., 1] + 0.0722 * rgb[..., 2]  # (列, 行)
+
+    mean = lum.mean(axis=0)
+    var = (lum * lum).mean(axis=0) - mean * mean
+    std = np.sqrt(np.maximum(var, 0.0))
+
+    score = mean + 0.3 * std
+    best_y = y_start + int(np.argmin(score))
 
     return min(h - 1, best_y + 1)
 
 
+# ステージ背景（ファイル名 -> (リサイズ済み画像, 地面Y)）
+_BG_CACHE: dict[str, tuple[pg.Surface, int]] = {}
+_BG_CONVERTED: set[str] = set()
+
+
+def prepare_background(bg_file: str, convert: bool = True, trace: "StartupTrace | None" = None) -> tuple[pg.Surface, int]:
+    """
+    背景画像を画面サイズに縮小し、地面Yを求める（結果はキャッシュ）。
+    convert=False は先読みスレッド用（convert は使う時にメインスレッドで行う）
+    trace を渡すと、読み込み・縮小・地面検出・convert を区間として記録する
+    """
+    cached = _BG_CACHE.get(bg_file)
+    if cached is None:
+        raw = _read_image(bg_file)
+        if trace is not None:
+            trace.step(f"bg load ({bg_file})")
+        img = pg.transform.smoothscale(raw, (WIDTH, HEIGHT))
+        if trace is not None:
+            trace.step("bg smoothscale")
+        cached = (img, detect_ground_y(img))
+        _BG_CACHE[bg_file] = cached
+        if trace is not None:
+            trace.step("bg detect_ground_y")
+    img, gy = cached
+    if convert and bg_file not in _BG_CONVERTED and pg.display.get_surface() is not None:
+        img = img.convert()
+        _BG_CACHE[bg_file] = (img, gy)
+        _BG_CONVERTED.add(bg_file)
+        if trace is not None:
+            trace.step("bg convert")
+    return img, gy
+
+
+def init_pygame() -> None:
+    """
+    使うモジュール（display / font）だけ初期化する（pg.init() は全サブシステムを起こして遅い）
+    """
+    pg.display.init()
+    pg.font.init()
+    _STARTUP_MARKS.append(("init_pygame", time.perf_counter()))
+
+
+class StartupTrace:
+    """
+    起動から最初のフレーム表示までの時間を区間ごとに記録する
+    """
+    def __init__(self, enabled: bool = True):
+        self._enabled = enabled
+        self._steps: list[tuple[str, float]] = []
+        if _STARTUP_MARKS:
+            # 最初の main()：import・init_pygame などの区間を引き継ぐ
+            self._last = _STARTUP_T0
+            for name, t in _STARTUP_MARKS:
+                self._steps.append((name, (t - self._last) * 1000))
+                self._last = t
+            _STARTUP_MARKS.clear()
+        else:
+            self._last = time.perf_counter()
+
+    def step(self, name: str) -> None:
+        if not self._enabled:
+            return
+        now = time.perf_counter()
+        self._steps.append((name, (now - self._last) * 1000))
+        self._last = now
+
+    def get_steps(self) -> list[tuple[str, float]]:
+        return self._steps
+
+    def report(self) -> None:
+        if not self._enabled:
+            return
+        total = 0.0
+        for name, ms in self._steps:
+            total += ms
+            print(f"startup {name:22s}{ms:8.1f} ms {total:8.1f} ms")
+
+
+def _prefetch_worker(bg_files: list[str], img_files: list[str], scaled: list[tuple[str, float]]) -> None:
+    for f, scale in scaled:
+        if (f, scale) not in _SCALED_CACHE and (f, scale) not in _PREFETCHED_SCALED:
+            _PREFETCHED_SCALED[(f, scale)] = pg.transform.rotozoom(_read_image(f), 0, scale)
+    for f in img_files:
+        if f not in _IMAGE_CACHE and f not in _PREFETCHED:
+            _PREFETCHED[f] = _read_image(f)
+    for f in bg_files:
+        prepare_background(f, convert=False)
+
+
+def start_prefetch(bg_files: list[str], img_files: list[str],
+                   scaled: list[tuple[str, float]] | None = None) -> threading.Thread:
+    """
+    すぐには要らない画像（敵・アイテム・爆発・ステージ2）を裏スレッドで先読みする。
+    scaled の (ファイル名, 倍率) は縮小済みの画像まで作っておく（load_scaled_image 用）。
+    （画像のデコードや縮小の間は GIL が外れるので、ゲームループはほぼ止まらない）
+    """
+    th = threading.Thread(target=_prefetch_worker, args=(bg_files, img_files, scaled or []),
+                          name="prefetch", daemon=True)
+    th.start()
+    return th
+
+
 # =========================
 # クラス
 # =========================
@@ -169,15 +352,14 @@ class Background:
     """
     背景を右→左へ強制スクロール（2枚並べてループ）
     """
-    def __init__(self, bg_file: str, speed: int):
-        raw = load_image(bg_file)
-        self._img = pg.transform.smoothscale(raw, (WIDTH, HEIGHT))
+    def __init__(self, bg_file: str, speed: int, trace: "StartupTrace | None" = None):
+        self._img, gy = prepare_background(bg_file, trace=trace)
         self._speed = speed
         self._x1 = 0
         self._x2 = WIDTH
-        set_ground_y(detect_ground_y(self._img))
+        set_ground_y(gy)
 
-    def update(self, screen: pg.Surface):
+    def update(self):
         self._x1 -= self._speed
         self._x2 -= self._speed
 
@@ -186,8 +368,11 @@ class Background:
         if self._x2 <= -WIDTH:
             self._x2 = self._x1 + WIDTH
 
-        screen.blit(self._img, (self._x1, 0))
-        screen.blit(self._img, (self._x2, 0))
+    def get_blits(self) -> list[tuple[pg.Surface, tuple[int, int]]]:
+        return [(self._img, (self._x1, 0)), (self._img, (self._x2, 0))]
+
+    def draw(self, screen: pg.Surface):
+        screen.blits(self.get_blits(), False)
 
 
 class Bird(pg.sprite.Sprite):
@@ -222,12 +407,15 @@ class Bird(pg.sprite.Sprite):
         self._inv = 0   # 無敵フレーム（連続ダメ防止）
 
 
-    def try_jump(self) -> None:
+    def try_jump(self) -> bool:
+        """ジャンプできたら True"""
         if self._jump_count < self._max_jump:
             self._vy = self._jump_v0
             self._jump_count += 1
+            return True
+        return False
 
-    def update(self, key_lst: list[bool], screen: pg.Surface) -> None:
+    def update(self, key_lst: list[bool]) -> None:
         # 左右入力
         self._vx = 0
         if key_lst[pg.K_LEFT]:
@@ -253,11 +441,13 @@ class Bird(pg.sprite.Sprite):
             self._jump_count = 0
 
         self.image = self._imgs[self._dir]
-        screen.blit(self.image, self.rect)
 
     def get_rect(self) -> pg.Rect:
         return self.rect
 
+    def get_image(self, direction: int = +1) -> pg.Surface:
+        return self._imgs[direction]
+
     def set_max_jump(self, n: int) -> None:
         self._max_jump = max(1, int(n))
 
@@ -281,6 +471,62 @@ class Bird(pg.sprite.Sprite):
         self._vy = v
 
 
+class GhostRecorder:
+    """
+    こうかとんの位置（rect.topleft）を毎フレーム int16 で記録し、終了時にファイルへ書く
+    """
+    MAGIC = b"DGGH"
+
+    def __init__(self, path: str):
+        self._path = path
+        self._xy = array.array("h")
+
+    def record(self, bird: Bird) -> None:
+        r = bird.get_rect()
+        self._xy.append(r.x)
+        self._xy.append(r.y)
+
+    def close(self) -> None:
+        with open(self._path, "wb") as f:
+            f.write(self.MAGIC)
+            if sys.byteorder != "little":
+                self._xy.byteswap()
+            self._xy.tofile(f)
+
+
+class GhostBirds:
+    """
+    過去ランのこうかとんを半透明で描く（ゴースト）。
+
+    - 軌跡ファイルは memmap で開く（全体は読み込まない）
+    - 半透明画像は最初に1回だけ作る（毎フレームは blit だけ）
+    - 向きは前フレームとの x の差から決める
+    """
+    def __init__(self, paths: list[str], bird: Bird, alpha: int = 90):
+        self._tracks = []
+        for path in paths:
+            with open(path, "rb") as f:
+                if f.read(len(GhostRecorder.MAGIC)) != GhostRecorder.MAGIC:
+                    raise ValueError(f"not a ghost file: {path}")
+            n = (os.path.getsize(path) - len(GhostRecorder.MAGIC)) // 4
+            if n > 0:
+                self._tracks.append(np.memmap(path, dtype="<i2", mode="r",
+                                              offset=len(GhostRecorder.MAGIC), shape=(n, 2)))
+        self._imgs = {}
+        for d in (+1, -1):
+            img = bird.get_image(d).copy()
+            img.fill((255, 255, 255, alpha), special_flags=pg.BLEND_RGBA_MULT)
+            self._imgs[d] = img
+
+    def draw(self, screen: pg.Surface, tmr: int) -> None:
+        for xy in self._tracks:
+            if tmr >= len(xy):
+                continue
+            x, y = xy[tmr]
+            d = -1 if tmr > 0 and x < xy[tmr - 1, 0] else +1
+            screen.blit(self._imgs[d], (int(x), int(y)))
+
+
 #変更高柳
 class Enemy(pg.sprite.Sprite):
     """
@@ -290,22 +536,21 @@ class Enemy(pg.sprite.Sprite):
     ステージ1: doragon1.png / gimen1.png
     ステージ2: doragon2.png / gimen2.png
     """
+    IMG_FILES = {
+        (1, "ground"): "enemy3.png", (1, "air"): "dagon.png",
+        (2, "ground"): "enemy4.png", (2, "air"): "stennow.png",
+    }
+    SCALE = 0.05  # サイズ調整（必要なら数字だけ変えてOK）
+
     def __init__(self, stage: int, kind: str = "ground", speed: int = 7):
         super().__init__()
         self.stage = stage
         self.kind = kind
 
         # ステージごとの画像を選ぶ（UFO/alienは使わない）
-        if self.stage == 1:
-            img_file = "enemy3.png" if self.kind == "ground" else "dagon.png"
-        else:
-            img_file = "enemy4.png" if self.kind == "ground" else "stennow.png"
-
-        base = load_image(img_file)
+        img_file = self.IMG_FILES[(1 if self.stage == 1 else 2, self.kind)]
 
-        # サイズ調整（必要なら数字だけ変えてOK）
-        scale = 0.05 if self.kind == "ground" else 0.05
-        self.image = pg.transform.rotozoom(base, 0, scale)
+        self.image = load_scaled_image(img_file, self.SCALE)
         self.rect = self.image.get_rect()
 
         # 右端から左へ流れる（地面と平行）
@@ -330,6 +575,9 @@ class Enemy(pg.sprite.Sprite):
         ):
             self.kill()
 
+    def get_kind(self) -> str:
+        return self.kind
+
     def get_rect(self) -> pg.Rect:
         return self.rect
 
@@ -343,10 +591,14 @@ class Explosion(pg.sprite.Sprite):
     """
     爆発エフェクト：中心で拡大縮小を繰り返しながら消滅
     """
+    _frames: list[pg.Surface] | None = None  # 全インスタンスで共有（初回の爆発で作る）
+
     def __init__(self, center_xy: tuple[int, int], life: int = 30):
         super().__init__()
-        img = load_image("explosion.gif")
-        self._imgs = [img, pg.transform.flip(img, True, True)] # 拡大縮小用に2枚用意
+        if Explosion._frames is None:
+            img = load_image("explosion.gif")
+            Explosion._frames = [img, pg.transform.flip(img, True, True)] # 拡大縮小用に2枚用意
+        self._imgs = Explosion._frames
         self.image = self._imgs[0]
         self.rect = self.image.get_rect(center=center_xy)
         self._life = life
@@ -430,6 +682,144 @@ class Arrow(pg.sprite.Sprite):
             self.kill()
 
 
+class BulletEngine:
+    """
+    敵弾（ボス・中ボスの弾幕）をまとめて扱う。
+
+    弾1発ごとに Sprite を作らず、位置・速度を NumPy 配列で持つ。
+    - spawn_radial / spawn_aimed / spawn_spiral でパターン単位にまとめて追加
+    - update() で全弾を1回で移動し、画面外の弾をまとめて消す
+    - hit() で当たり判定用の矩形との衝突をまとめて判定し、当たった弾を消す
+    - draw() は弾画像を1枚だけ作っておき、blits で一括描画
+    """
+    MARGIN = 16  # 画面外判定の余白
+
+    def __init__(self, radius: int = 5, color: tuple[int, int, int] = (255, 60, 160), capacity: int = 1024):
+        self._r = radius
+        self._x = np.empty(capacity, dtype=np.float32)
+        self._y = np.empty(capacity, dtype=np.float32)
+        self._vx = np.empty(capacity, dtype=np.float32)
+        self._vy = np.empty(capacity, dtype=np.float32)
+        self._n = 0
+
+        self._img = pg.Surface((radius * 2, radius * 2), pg.SRCALPHA)
+        pg.draw.circle(self._img, color, (radius, radius), radius)
+        pg.draw.circle(self._img, (255, 255, 255), (radius, radius), max(1, radius // 2))
+
+    def __len__(self) -> int:
+        return self._n
+
+    def get_image(self) -> pg.Surface:
+        return self._img
+
+    def _reserve(self, k: int) -> None:
+        need = self._n + k
+        cap = len(self._x)
+        if need <= cap:
+            return
+        while cap < need:
+            cap *= 2
+        for name in ("_x", "_y", "_vx", "_vy"):
+            old = getattr(self, name)
+            new = np.empty(cap, dtype=np.float32)
+            new[:self._n] = old[:self._n]
+            setattr(self, name, new)
+
+    def _spawn(self, x, y, angles: np.ndarray, speed: float) -> None:
+        k = len(angles)
+        self._reserve(k)
+        n = self._n
+        self._x[n:n + k] = x
+        self._y[n:n + k] = y
+        self._vx[n:n + k] = np.cos(angles) * speed
+        self._vy[n:n + k] = np.sin(angles) * speed
+        self._n = n + k
+
+    def spawn_radial(self, cx: float, cy: float, count: int, speed: float, offset_deg: float = 0.0) -> None:
+        """
+        全方位に count 発を等間隔でばらまく
+        """
+        angles = np.radians(offset_deg) + np.arange(count) * (2 * np.pi / count)
+        self._spawn(cx, cy, angles, speed)
+
+    def spawn_aimed(self, cx: float, cy: float, target: tuple[int, int], count: int, speed: float,
+                    spread_deg: float = 0.0) -> None:
+        """
+        target へ向けて count 発を扇状（spread_deg の幅）に撃つ
+        """
+        base = math.atan2(target[1] - cy, target[0] - cx)
+        if count == 1:
+            angles = np.array([base])
+        else:
+            angles = base + np.radians(np.linspace(-spread_deg / 2, spread_deg / 2, count))
+        self._spawn(cx, cy, angles, speed)
+
+    def spawn_spiral(self, cx: float, cy: float, arms: int, speed: float, tmr: int, turn_deg: float = 7.0) -> None:
+        """
+        毎フレーム呼ぶと回転する渦巻きになる（tmr ごとに turn_deg ずつずらす）
+        """
+        self.spawn_radial(cx, cy, arms, speed, offset_deg=tmr * turn_deg)
+
+    def _keep(self, keep: np.ndarray) -> None:
+        k = int(np.count_nonzero(keep))
+        if k == self._n:
+            return
+        n = self._n
+        for arr in (self._x, self._y, self._vx, self._vy):
+            arr[:k] = arr[:n][keep]
+        self._n = k
+
+    def update(self) -> None:
+        n = self._n
+        if n == 0:
+            return
+        x = self._x[:n]
+        y = self._y[:n]
+        x += self._vx[:n]
+        y += self._vy[:n]
+        m = self.MARGIN
+        self._keep((x > -m) & (x < WIDTH + m) & (y > -m) & (y < HEIGHT + m))
+
+    def hit(self, rect: pg.Rect) -> int:
+        """
+        rect（円と矩形の判定）に当たった弾を消し、その数を返す
+        """
+        n = self._n
+        if n == 0:
+            return 0
+        x = self._x[:n]
+        y = self._y[:n]
+        dx = x - np.clip(x, rect.left, rect.right)
+        dy = y - np.clip(y, rect.top, rect.bottom)
+        hits = dx * dx + dy * dy < self._r * self._r
+        cnt = int(np.count_nonzero(hits))
+        if cnt:
+            self._keep(~hits)
+        return cnt
+
+    def clear(self) -> None:
+        self._n = 0
+
+    def collect_blits(self, out: list) -> None:
+        """
+        描画内容 (画像, 左上座標) を out に追加する（RenderState 用）
+        """
+        n = self._n
+        if n == 0:
+            return
+        pos = np.empty((n, 2), dtype=np.int32)
+        pos[:, 0] = self._x[:n] - self._r
+        pos[:, 1] = self._y[:n] - self._r
+        img = self._img
+        out.extend([(img, p) for p in pos.tolist()])
+
+    def draw(self, screen: pg.Surface) -> None:
+        blits = []
+        self.collect_blits(blits)
+        if blits:
+            screen.blits(blits, False)
+
+
 class ItemDef:
     """
     アイテムの“定義情報”を保持するクラス（スポーンや描画用）。
@@ -440,13 +830,19 @@ class ItemDef:
     - img_file: 画像ファイル名
     - weight: 重み付き抽選で使う重み
     - scale: 描画倍率（Item生成時に適用）
+    - stage_weights: ステージ別に重みを変える場合の {stage: weight}（無指定のステージは weight）
     """
-    def __init__(self, item_id: str, category: str, img_file: str, weight: int, scale: float = 1.0):
+    # 重みが変わるたびに増える（抽選テーブルの作り直し判定用）
+    _weights_version = 0
+
+    def __init__(self, item_id: str, category: str, img_file: str, weight: int, scale: float = 1.0,
+                 stage_weights: dict[int, int] | None = None):
         self._item_id = item_id          # "Beam", "kinoko" など
         self._category = category        # "attack" or "status"
         self._img_file = img_file        # 画像ファイル名
         self._weight = weight
         self._scale = scale
+        self._stage_weights = dict(stage_weights) if stage_weights else {}
 
     def get_item_id(self) -> str:
         return self._item_id
@@ -457,9 +853,18 @@ class ItemDef:
     def get_img_file(self) -> str:
         return self._img_file
     
-    def get_weight(self) -> int:
+    def get_weight(self, stage: int | None = None) -> int:
+        if stage is not None and stage in self._stage_weights:
+            return self._stage_weights[stage]
         return self._weight
 
+    def set_weight(self, weight: int, stage: int | None = None) -> None:
+        if stage is None:
+            self._weight = weight
+        else:
+            self._stage_weights[stage] = weight
+        ItemDef._weights_version += 1
+
     def get_scale(self) -> float:
         return self._scale
 
@@ -507,10 +912,7 @@ class Item(pg.sprite.Sprite):
         self._category = idef.get_category()
         self._speed = stage_params(stage)["item_speed"]
 
-        img = load_image(idef.get_img_file())
-        if idef.get_scale() != 1.0:
-            img = pg.transform.rotozoom(img, 0, idef.get_scale())
-        self.image = img
+        self.image = load_scaled_image(idef.get_img_file(), idef.get_scale())
         self.rect = self.image.get_rect()
 
         self.rect.left = WIDTH + random.randint(0, 200)
@@ -534,7 +936,10 @@ class Item(pg.sprite.Sprite):
 
     def get_category(self) -> str:
         return self._category
-    
+
+    def get_rect(self) -> pg.Rect:
+        return self.rect
+
 
 # スポーン間隔(フレーム) と スポーン確率
 ITEM_SPAWN_INTERVAL_STAGE1 = 90   # 1.5秒(60FPS想定)
@@ -542,6 +947,224 @@ ITEM_SPAWN_INTERVAL_STAGE2 = 70
 ITEM_SPAWN_PROB_STAGE1 = 0.55
 ITEM_SPAWN_PROB_STAGE2 = 0.65
 
+# スポーン予算（SpawnController の既定値）
+SPAWN_BUDGETS = {"enemies": 10, "items": 4}  # グループごとの同時存在数の上限
+SPAWN_GLOBAL_BUDGET = 96                     # プレイヤー・敵弾以外の全エンティティ数の上限
+SPAWN_FRAME_BUDGET = 0.8 / FPS               # 1フレームの処理時間の目安（秒）。超えると全体の上限を絞る
+
+
+class SpawnController:
+    """
+    スポーンの予算管理（出しすぎ防止）。
+
+    - グループごとの上限（budgets）と全体の上限（global_budget）を超えるスポーンは止める。
+      敵弾（bullets）は BulletEngine で数百〜数千発まとめて扱うので全体の数には入れない
+    - 処理時間（描画・シミュレーションの時間。clock.tick の待ちは含まない）の平滑値が
+      frame_budget を超えている間は全体の上限を 3/4、その1.5倍を超えたら 1/2 に絞る
+    - 止めた敵は捨てずに積んでおき（max_deferred 体まで、溢れた分は間引き）、
+      上限を下回ったら defer_gap フレームごとに1体ずつ出す。アイテムは間引くだけ
+    - 判定に乱数は使わない。ただし frame_budget は実時間（マシンの速さ・負荷）で決まるので、
+      既定のままでは同じシードでも別のマシンや別の回で結果が変わりうる。
+      同じシードで同じランを再現したい時（ソークテスト・ベンチマーク・リプレイ）は frame_budget=None にする
+    """
+    DEFERRABLE = ("enemies",)
+    UNCOUNTED = ("player", "bullets")  # 全体の上限に数えないレイヤー
+
+    def __init__(self, budgets: dict[str, int] | None = None, global_budget: int = SPAWN_GLOBAL_BUDGET,
+                 frame_budget: float | None = SPAWN_FRAME_BUDGET, max_deferred: int = 4, defer_gap: int = 15):
+        self._budgets = dict(SPAWN_BUDGETS if budgets is None else budgets)
+        self._global_budget = global_budget
+        self._frame_budget = frame_budget
+        self._max_deferred = max_deferred
+        self._defer_gap = defer_gap
+        self._busy = 0.0       # 処理時間（指数移動平均）
+        self._pressure = 0     # 0: 通常 / 1: 超過 / 2: 大幅超過
+        self._pending = {name: 0 for name in self.DEFERRABLE}
+        self._last_release = {name: -defer_gap for name in self.DEFERRABLE}
+        self._stats: dict[str, dict[str, int]] = {}
+        for name in (*self._budgets, *self.DEFERRABLE):
+            self._stat(name)
+
+    def note_frame(self, busy_sec: float) -> None:
+        """
+        1フレームの処理時間を渡す（main から毎フレーム）
+        """
+        if self._frame_budget is None:
+            return
+        self._busy += 0.05 * (busy_sec - self._busy)
+        lo = self._frame_budget
+        hi = self._frame_budget * 1.5
+        # 境界付近で行き来しないよう、下げるときは 9 割まで戻ってから
+        if self._busy > hi:
+            self._pressure = 2
+        elif self._busy < lo * 0.9:
+            self._pressure = 0
+        elif self._busy > lo or self._pressure == 2:
+            self._pressure = 2 if self._pressure == 2 and self._busy > hi * 0.9 else 1
+
+    def get_pressure(self) -> int:
+        return self._pressure
+
+    def _stat(self, group: str) -> dict[str, int]:
+        stats = self._stats.get(group)
+        if stats is None:
+            stats = self._stats[group] = {"spawned": 0, "deferred": 0, "released": 0, "thinned": 0}
+        return stats
+
+    def _fits(self, group: str, counts: dict[str, int]) -> bool:
+        if counts.get(group, 0) >= self._budgets.get(group, 1 << 30):
+            return False
+        total = sum(n for name, n in counts.items() if name not in self.UNCOUNTED)
+        limit = self._global_budget
+        if self._pressure == 1:
+            limit = limit * 3 // 4
+        elif self._pressure == 2:
+            limit = limit // 2
+        return total < limit
+
+    def request(self, group: str, scene: "Scene") -> bool:
+        """
+        group に1体出してよいか。止めた場合は積む（敵）か間引く（それ以外）
+        """
+        stats = self._stat(group)
+        if self._fits(group, scene.counts()):
+            stats["spawned"] += 1
+            return True
+        if group in self._pending and self._pending[group] < self._max_deferred:
+            self._pending[group] += 1
+            stats["deferred"] += 1
+        else:
+            stats["thinned"] += 1
+        return False
+
+    def release(self, group: str, tmr: int, scene: "Scene") -> bool:
+        """
+        積んでおいた group を1体出すタイミングか（毎フレーム呼ぶ）
+        """
+        if not self._pending.get(group) or tmr - self._last_release[group] < self._defer_gap:
+            return False
+        if not self._fits(group, scene.counts()):
+            return False
+        self._pending[group] -= 1
+        self._last_release[group] = tmr
+        self._stat(group)["released"] += 1
+        return True
+
+    def clear_pending(self) -> None:
+        """
+        積んである分を捨てる（ステージ切替時など）
+        """
+        for name in self._pending:
+            self._stat(name)["thinned"] += self._pending[name]
+            self._pending[name] = 0
+
+    def get_pending(self) -> dict[str, int]:
+        return dict(self._pending)
+
+    def get_stats(self) -> dict[str, dict[str, int]]:
+        """
+        グループごとの {spawned, deferred, released, thinned} の累計
+        """
+        return {name: dict(s) for name, s in self._stats.items()}
+
+
+class LootTable:
+    """
+    item_defs の重みから作るステージ別の抽選テーブル（エイリアス法）。
+
+    - 1個の抽選は O(1)（乱数1回＋表引き1回）
+    - まとめて n 個の抽選は NumPy で一括（シミュレーション・パラメータ掃引用）
+    - テーブルはステージごとに初回利用時に作り、重みか item_defs の中身（キー・ItemDef）が変わった時だけ作り直す
+    """
+    def __init__(self, item_defs: dict[str, ItemDef]):
+        self._defs = item_defs
+        self._ids = list(item_defs.keys())
+        self._entries = tuple(item_defs.items())  # ItemDef は __eq__ を持たないので比較は同一性
+        self._tables: dict[int, tuple[list[float], list[int]] | None] = {}
+        self._version = ItemDef._weights_version
+
+    def get_ids(self) -> list[str]:
+        return self._ids
+
+    def get_defs(self) -> dict[str, ItemDef]:
+        return self._defs
+
+    def _table(self, stage: int) -> tuple[list[float], list[int]] | None:
+        if self._version != ItemDef._weights_version or tuple(self._defs.items()) != self._entries:
+            self._ids = list(self._defs.keys())
+            self._entries = tuple(self._defs.items())
+            self._tables.clear()
+            self._version = ItemDef._weights_version
+        if stage not in self._tables:
+            self._tables[stage] = self._build(stage)
+        return self._tables[stage]
+
+    def _build(self, stage: int) -> tuple[list[float], list[int]] | None:
+        """
+        Vose のエイリアス法で (prob, alias) を作る。重みが全部0なら None
+        """
+        weights = [max(0, self._defs[i].get_weight(stage)) for i in self._ids]
+        total = sum(weights)
+        n = len(weights)
+        if total <= 0:
+            return None
+
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        return prob, alias
+
+    def pick(self, stage: int, rng: random.Random | None = None) -> str:
+        table = self._table(stage)
+        if table is None:
+            # 全部0なら先頭
+            return self._ids[0]
+        prob, alias = table
+        u = (rng or random).random() * len(prob)
+        i = int(u)
+        return self._ids[i] if u - i < prob[i] else self._ids[alias[i]]
+
+    def pick_batch(self, stage: int, n: int, rng: np.random.Generator | None = None) -> np.ndarray:
+        """
+        n 個まとめて抽選し、item_id のインデックス配列（get_ids() の添字）を返す
+        """
+        table = self._table(stage)
+        if table is None:
+            return np.zeros(n, dtype=np.intp)
+        if rng is None:
+            rng = np.random.default_rng()
+        prob = np.asarray(table[0])
+        alias = np.asarray(table[1], dtype=np.intp)
+        i = rng.integers(0, len(prob), size=n)
+        return np.where(rng.random(n) < prob[i], i, alias[i])
+
+
+# 直近に使った item_defs の抽選テーブル
+_LOOT_TABLE: LootTable | None = None
+
+
+def get_loot_table(item_defs: dict[str, ItemDef]) -> LootTable:
+    """
+    item_defs に対応する LootTable を返す（初回だけ作る）
+    ※覚えておくのは直近の1つだけ（main() はラン毎に ITEM_DEFS を作り直すので、溜め込まない）
+    """
+    global _LOOT_TABLE
+    if _LOOT_TABLE is None or _LOOT_TABLE.get_defs() is not item_defs:
+        _LOOT_TABLE = LootTable(item_defs)
+    return _LOOT_TABLE
+
 
 def pick_weighted_item_id(item_defs: dict[str, ItemDef], stage: int) -> str:
     """
@@ -549,34 +1172,32 @@ def pick_weighted_item_id(item_defs: dict[str, ItemDef], stage: int) -> str:
 
     Args:
         item_defs: item_id -> ItemDef の辞書
-        stage: 現状は抽選ロジックに影響しないが、将来ステージ別抽選に拡張できるため引数として保持
+        stage: ステージ番号（ItemDef の stage_weights があればそちらの重みを使う）
 
     Returns:
         str: 抽選された item_id
     """
-    ids = list(item_defs.keys())
-    weights = [max(0, item_defs[i].get_weight()) for i in ids]
-    total = sum(weights)
-    if total <= 0:
-        # 全部0なら先頭
-        return ids[0]
+    return get_loot_table(item_defs).pick(stage)
 
-    r = random.randint(1, total)
-    acc = 0
-    for i, w in zip(ids, weights):
-        acc += w
-        if r <= acc:
-            return i
-    return ids[-1]
+
+def pick_weighted_item_ids(item_defs: dict[str, ItemDef], stage: int, n: int,
+                           rng: np.random.Generator | None = None) -> np.ndarray:
+    """
+    pick_weighted_item_id の一括版。n 個の item_id を配列で返す（シミュレーション用）
+    """
+    table = get_loot_table(item_defs)
+    return np.asarray(table.get_ids())[table.pick_batch(stage, n, rng)]
 
 
-def maybe_spawn_item(tmr: int, stage: int, item_defs: dict[str, ItemDef], items: pg.sprite.Group) -> None:
+def maybe_spawn_item(tmr: int, stage: int, item_defs: dict[str, ItemDef], items: pg.sprite.Group,
+                     allow=None) -> Item | None:
     """
-    アイテムをスポーンするかを判定し、スポーンする場合は items に追加する。
+    アイテムをスポーンするかを判定し、スポーンする場合は items に追加する（追加した Item を返す）。
 
     - stage に応じてスポーン間隔(interval)と確率(prob)を切り替える
     - tmr が interval の倍数のタイミングのみ抽選する
     - 当選したら重み付き抽選で item_id を選ぶ
+    - allow() が False を返したら（スポーン予算オーバー）出さない
     """
     if stage == 1:
         interval = ITEM_SPAWN_INTERVAL_STAGE1
@@ -586,13 +1207,18 @@ def maybe_spawn_item(tmr: int, stage: int, item_defs: dict[str, ItemDef], items:
         prob = ITEM_SPAWN_PROB_STAGE2
 
     if tmr % interval != 0:
-        return
+        return None
 
     if random.random() > prob:
-        return
+        return None
+
+    if allow is not None and not allow():
+        return None
 
     item_id = pick_weighted_item_id(item_defs, stage)
-    items.add(Item(item_defs[item_id], stage))
+    it = Item(item_defs[item_id], stage)
+    items.add(it)
+    return it
     
 def apply_status_pickup(item_id: str, inv: Inventory, bird: Bird) -> None:
     """
@@ -643,25 +1269,846 @@ def apply_status_from_current(inv: Inventory, bird: Bird) -> None:
 
 
 # =========================
-# メイン
+# シーン
 # =========================
-def main():
-    pg.display.set_caption("こうかとん横スクロール（ベース）")
-    screen = pg.display.set_mode((WIDTH, HEIGHT))
-    clock = pg.time.Clock()
+class Scene:
+    """
+    画面上のエンティティをレイヤーごとにまとめて持つ。
 
-   
+    - 各レイヤーは Group（または update()/draw(screen)/len() を持つもの。例: BulletEngine）
+    - update() は UPDATE_ORDER の順に、draw() は DRAW_ORDER の順に、各レイヤー1回ずつ
+    - draw() はレイヤーごとに1回の一括描画（Group.draw / blits）
+    - 非表示にしたレイヤーは描画だけ飛ばす（更新は続ける）
+    - scene["enemies"] のように名前でレイヤーを取り出せる
+    """
+    UPDATE_ORDER = ("player", "enemies", "items", "beams", "arrows", "exps", "bullets")
+    DRAW_ORDER = ("player", "items", "enemies", "beams", "arrows", "exps", "bullets")
 
-    stage = 1
-    params = stage_params(stage)
+    def __init__(self, bullets: BulletEngine | None = None):
+        self._layers = {name: pg.sprite.Group() for name in self.UPDATE_ORDER}
+        self._layers["bullets"] = bullets if bullets is not None else BulletEngine()
+        self._visible = {name: True for name in self.DRAW_ORDER}
 
-    bg = Background(params["bg_file"], params["bg_speed"])
-    bird = Bird(3, (200, get_ground_y()))
-    enemies = pg.sprite.Group()
-    items = pg.sprite.Group()
-    beams = pg.sprite.Group()
-    arrows = pg.sprite.Group()
-    exps = pg.sprite.Group()
+    def __getitem__(self, name: str):
+        return self._layers[name]
+
+    def get_layer(self, name: str):
+        return self._layers[name]
+
+    def set_visible(self, name: str, visible: bool) -> None:
+        self._visible[name] = visible
+
+    def get_visible(self, name: str) -> bool:
+        return self._visible[name]
+
+    def update(self, **layer_args) -> None:
+        """
+        全レイヤーを1回ずつ更新する。引数が必要なレイヤーは名前で渡す
+        （例: scene.update(player=(key_lst,))）
+        """
+        for name in self.UPDATE_ORDER:
+            self._layers[name].update(*layer_args.get(name, ()))
+
+    def draw(self, screen: pg.Surface) -> None:
+        for name in self.DRAW_ORDER:
+            if self._visible[name]:
+                self._layers[name].draw(screen)
+
+    def collect_blits(self, out: list) -> None:
+        """
+        表示中のレイヤーの描画内容 (画像, 左上座標) を描画順に out へ追加する。
+        位置はコピーするので、この後 update() しても out は変わらない
+        """
+        for name in self.DRAW_ORDER:
+            if not self._visible[name]:
+                continue
+            layer = self._layers[name]
+            if isinstance(layer, pg.sprite.AbstractGroup):
+                out.extend([(sp.image, sp.rect.topleft) for sp in layer])
+            else:
+                layer.collect_blits(out)
+
+    def counts(self) -> dict[str, int]:
+        """
+        レイヤーごとのエンティティ数
+        """
+        return {name: len(layer) for name, layer in self._layers.items()}
+
+
+# =========================
+# 入力
+# =========================
+class KeyboardInput:
+    """
+    通常プレイ用の入力ソース（キーボード）。
+
+    main() は毎フレーム poll(bird, scene, inv) を呼び、返ってきた
+    (押下状態, イベント列) を使って操作を処理する。
+    ボットなどで差し替える場合も同じ形で返せばよい。
+    """
+    def poll(self, bird: Bird, scene: Scene, inv: Inventory) -> tuple:
+        return pg.key.get_pressed(), pg.event.get()
+
+
+class BotInput:
+    """
+    自動プレイ用の入力ソース（計測用ボット）。
+
+    ゲーム状態（bird / 敵 / アイテム / 所持品）を見て、
+    左右移動・ジャンプ(K_UP)・発射(K_SPACE)を決める。
+    乱数は使わないので、同じシードのゲームなら同じ操作になる。
+
+    プロファイル:
+    - idle          : 何もしない（最小負荷）
+    - survivor      : 敵をジャンプで避け、アイテムを拾い、敵が前にいる時だけ撃つ
+    - trigger_happy : 避けつつ、拾った攻撃アイテムを毎フレーム撃ち続ける（弾数最大）
+    """
+    PROFILES = {
+        "idle": {"dodge": False, "chase_items": False, "fire_on_sight": False, "fire_every": 0},
+        "survivor": {"dodge": True, "chase_items": True, "fire_on_sight": True, "fire_every": 0},
+        "trigger_happy": {"dodge": True, "chase_items": True, "fire_on_sight": False, "fire_every": 1},
+    }
+    LOOKAHEAD_PX = 90    # この距離まで近づいた敵をジャンプで避ける
+    FIRE_RANGE_PX = 220  # この距離以内に敵がいたら撃つ（fire_on_sight）
+
+    def __init__(self, profile: str = "survivor"):
+        if profile not in self.PROFILES:
+            raise ValueError(f"unknown bot profile: {profile}")
+        self._profile = profile
+        self._cfg = self.PROFILES[profile]
+        self._keys = {pg.K_LEFT: False, pg.K_RIGHT: False}
+        self._frame = 0
+
+    def get_profile(self) -> str:
+        return self._profile
+
+    def poll(self, bird: Bird, scene: Scene, inv: Inventory) -> tuple:
+        # キュー溢れ防止に捨てるが、QUIT だけは通す
+        events = [e for e in pg.event.get() if e.type == pg.QUIT]
+        self._frame += 1
+        cfg = self._cfg
+        b = bird.get_rect()
+        grounded = bird.get_vy() == 0.0
+
+        jump = False
+        nearest = None
+        for e in scene["enemies"]:
+            r = e.get_rect()
+            dx = r.left - b.right
+            if dx < -r.width:
+                continue
+            if nearest is None or dx < nearest:
+                nearest = dx
+            # 同じ高さ帯の敵が目の前に来たらジャンプ
+            if cfg["dodge"] and grounded and dx < self.LOOKAHEAD_PX and r.bottom > b.top:
+                jump = True
+
+        left = right = False
+        if cfg["chase_items"]:
+            target = None
+            for it in scene["items"]:
+                r = it.get_rect()
+                if r.right < b.left:
+                    continue
+                if target is None or r.left < target.left:
+                    target = r
+            if target is not None:
+                if target.centerx > b.centerx + 20:
+                    right = True
+                elif target.centerx < b.centerx - 20:
+                    left = True
+                if grounded and target.left - b.right < 60 and target.bottom < b.top:
+                    jump = True
+        self._keys[pg.K_LEFT] = left
+        self._keys[pg.K_RIGHT] = right
+
+        if jump:
+            events.append(pg.event.Event(pg.KEYDOWN, key=pg.K_UP))
+
+        fire = False
+        if inv.get_attack() is not None:
+            if cfg["fire_every"] and self._frame % cfg["fire_every"] == 0:
+                fire = True
+            if cfg["fire_on_sight"] and nearest is not None and 0 <= nearest < self.FIRE_RANGE_PX:
+                fire = True
+        if fire:
+            events.append(pg.event.Event(pg.KEYDOWN, key=pg.K_SPACE))
+
+        return self._keys, events
+
+
+class LatencyTracker:
+    """
+    入力から、それが最初に画面へ反映されたフレームの表示までの遅延を記録する。
+
+    - 入力時刻はイベントの timestamp（SDL のミリ秒）を使う。
+      持っていない環境（pygame 2.6 など・ボット入力）では、入力は前回の読み取りから今回の読み取りまでの
+      どこかで届いたとみなし、その中点で推定する（読み取りまでの待ちも含めるので、LOW_LATENCY_INPUT の
+      有無で比べられる）。読み取り間隔も "poll_gap" として記録する
+    - mark() で「このイベントで何かが起きた」（ジャンプ開始・弾の発射）をフレーム番号付きで登録し、
+      presented() でそのフレームの表示完了時刻との差を確定させる
+    """
+    def __init__(self):
+        self._pending: list[tuple[str, float, int]] = []
+        self._samples: dict[str, list[float]] = {}
+        self._poll_t = 0.0
+        self._prev_poll_t = None
+        self._poll_ticks = 0
+
+    def polled(self) -> None:
+        """
+        入力を読んだ直後に呼ぶ（timestamp が無いイベントの入力時刻の推定に使う）
+        """
+        now = time.perf_counter()
+        self._prev_poll_t = self._poll_t if self._poll_t > 0 else None
+        self._poll_t = now
+        self._poll_ticks = pg.time.get_ticks()
+        if self._prev_poll_t is not None:
+            self._samples.setdefault("poll_gap", []).append((now - self._prev_poll_t) * 1000)
+
+    def mark(self, kind: str, event: pg.event.Event, frame: int) -> None:
+        ts = getattr(event, "timestamp", None)
+        if ts is not None:
+            t = self._poll_t - max(0, self._poll_ticks - ts) / 1000
+        elif self._prev_poll_t is not None:
+            t = (self._prev_poll_t + self._poll_t) / 2
+        else:
+            t = self._poll_t
+        self._pending.append((kind, t, frame))
+
+    def presented(self, frame: int) -> None:
+        """
+        frame を表示した pg.display.update() の直後に呼ぶ
+        """
+        if not self._pending:
+            return
+        now = time.perf_counter()
+        rest = []
+        for kind, t, f in self._pending:
+            if f <= frame:
+                self._samples.setdefault(kind, []).append((now - t) * 1000)
+            else:
+                rest.append((kind, t, f))
+        self._pending = rest
+
+    def get_summary(self) -> dict[str, dict[str, float]]:
+        """
+        種類ごとの分布（ms）: count / mean / p50 / p90 / p99 / max
+        """
+        out = {}
+        for kind, xs in self._samples.items():
+            a = np.asarray(xs)
+            p50, p90, p99 = np.percentile(a, [50, 90, 99])
+            out[kind] = {"count": len(a), "mean": float(a.mean()), "p50": float(p50),
+                         "p90": float(p90), "p99": float(p99), "max": float(a.max())}
+        return out
+
+    def report(self) -> None:
+        for kind, st in sorted(self.get_summary().items()):
+            print(f"input latency [{kind}] n={st['count']} mean={st['mean']:.1f}ms "
+                  f"p50={st['p50']:.1f} p90={st['p90']:.1f} p99={st['p99']:.1f} max={st['max']:.1f}")
+
+
+class LatePoller:
+    """
+    入力をなるべく遅く読むためのフレーム待ち（低遅延モード）。
+
+    通常は「表示 → 残り時間を待つ → 入力を読む」なので、待っている間に来た入力は
+    次のフレームの処理時間ぶん待たされる。低遅延モードでは、表示の締め切り（1フレームごとに
+    period ずつ進む固定の時刻）から予測処理時間を引いた時刻まで待ってから入力を読み、
+    すぐにシミュレーション・描画まで進め、締め切りになったら表示する。
+    締め切りは前回の表示時刻ではなく前回の締め切りから進めるので、フレームの周期は fps のまま変わらない。
+
+    ※効果があるのは表示が一定周期（垂直同期）で出る環境だけ。
+      垂直同期の無い環境（pygame の通常の display.update）では、通常モードも入力を読む直前まで
+      待っているので、入力〜表示の時間は変わらない
+    """
+    MARGIN = 0.001  # 予測が外れた時のための余裕（秒）
+
+    def __init__(self, fps: int):
+        self._period = 1.0 / fps if fps > 0 else 0.0
+        self._work = 0.0        # 入力〜表示の処理時間（指数移動平均）
+        self._deadline = None   # 次の表示の締め切り
+        self._poll_t = 0.0
+        self._ready_t = None    # 表示待ちに入った時刻
+        self._present_t = 0.0   # 表示待ちが明けた時刻
+        self._waited = 0.0
+
+    def _sleep_until(self, t: float) -> None:
+        delay = t - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait(self) -> None:
+        """
+        入力を読む直前に呼ぶ
+        """
+        t = time.perf_counter()
+        if self._period > 0 and self._deadline is not None:
+            self._sleep_until(self._deadline - self._work - self.MARGIN)
+        self._poll_t = time.perf_counter()
+        self._waited = self._poll_t - t
+
+    def before_present(self) -> None:
+        """
+        pg.display.update() の直前に呼ぶ（締め切りより前には表示しない）
+        """
+        self._ready_t = time.perf_counter()
+        if self._period > 0 and self._deadline is not None:
+            self._sleep_until(self._deadline)
+        self._present_t = time.perf_counter()
+        self._waited += self._present_t - self._ready_t
+
+    def get_waited(self) -> float:
+        """
+        このフレームで wait() / before_present() が待った時間（秒）
+        """
+        return self._waited
+
+    def presented(self) -> None:
+        """
+        pg.display.update() の直後に呼ぶ
+        """
+        now = time.perf_counter()
+        # 処理時間には表示待ちを含めない（含めると入力を読む時刻が毎フレーム早まっていく）
+        work = now - self._poll_t
+        if self._ready_t is not None:
+            work -= self._present_t - self._ready_t
+        self._work += 0.1 * (work - self._work)
+        if self._period <= 0:
+            return
+        if self._deadline is None or now - self._deadline > self._period:
+            # 最初のフレーム、または1フレーム以上遅れた時は今から数え直す
+            self._deadline = now + self._period
+        else:
+            self._deadline += self._period
+
+
+# =========================
+# 録画
+# =========================
+def surface_pixel_format(masks: tuple[int, int, int, int], bytesize: int) -> str:
+    """
+    1ピクセルのバイト並びを "bgra" のような文字列で返す（未使用バイトは "x"）
+    """
+    order = []
+    for k in range(bytesize):
+        shift = 8 * k if sys.byteorder == "little" else 8 * (bytesize - 1 - k)
+        ch = "x"
+        for name, m in zip("rgba", masks):
+            if m == 0xFF << shift:
+                ch = name
+        order.append(ch)
+    return "".join(order)
+
+
+class FrameCapture:
+    """
+    描画済みの画面を録画する。
+
+    - 画面ピクセルは使い回しのバッファ（プール）へコピーするだけ（フレームごとの確保なし）
+    - 圧縮・書き出しは別スレッド（zlib / ffmpeg への書き込み中は GIL が外れる）
+    - 書き出しが追いつかずプールが空なら、そのフレームは捨てて数える（ゲームは止めない）
+
+    .dgcap 形式:
+        HEADER（magic, w, h, pitch, bytesize, 各mask, fps）に続いて
+        FRAME（フレーム番号, 圧縮長）+ zlib 圧縮したピクセル列 の繰り返し
+    """
+    MAGIC = b"DGCAP1"
+    HEADER = struct.Struct("<6sHHIB4IH")
+    FRAME = struct.Struct("<II")
+    FFMPEG_PIX = {"bgra": "bgra", "rgba": "rgba", "argb": "argb", "abgr": "abgr",
+                  "bgrx": "bgr0", "rgbx": "rgb0", "xrgb": "0rgb", "xbgr": "0bgr",
+                  "bgr": "bgr24", "rgb": "rgb24"}
+
+    def __init__(self, path: str, surf: pg.Surface, fps: int = FPS, every: int = 1, pool_size: int = 6):
+        w, h = surf.get_size()
+        pitch = surf.get_pitch()
+        self._every = max(1, every)
+        self._frame = 0
+        self._captured = 0
+        self._dropped = 0
+        self._pool = [bytearray(pitch * h) for _ in range(pool_size)]
+        self._free: queue.Queue = queue.Queue()
+        for i in range(pool_size):
+            self._free.put(i)
+        self._work: queue.Queue = queue.Queue(maxsize=pool_size)
+        self._fp = None
+        self._proc = None
+
+        if path.endswith(".dgcap"):
+            self._fp = open(path, "wb")
+            self._fp.write(self.HEADER.pack(self.MAGIC, w, h, pitch, surf.get_bytesize(),
+                                            *surf.get_masks(), fps // self._every))
+        else:
+            ffmpeg = shutil.which("ffmpeg")
+            pix = self.FFMPEG_PIX.get(surface_pixel_format(surf.get_masks(), surf.get_bytesize()))
+            if ffmpeg is None or pix is None:
+                raise SystemExit(f"録画 '{path}' には ffmpeg が必要です（.dgcap なら不要）")
+            self._proc = subprocess.Popen(
+                [ffmpeg, "-loglevel", "error", "-y",
+                 "-f", "rawvideo", "-pix_fmt", pix,
+                 "-s", f"{pitch // surf.get_bytesize()}x{h}", "-r", str(fps // self._every),
+                 "-i", "-", "-vf", f"crop={w}:{h}:0:0", path],
+                stdin=subprocess.PIPE,
+            )
+        self._thread = threading.Thread(target=self._worker, name="FrameCapture", daemon=True)
+        self._thread.start()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._work.get()
+            if job is None:
+                return
+            idx, frame_no = job
+            buf = self._pool[idx]
+            if self._proc is not None:
+                self._proc.stdin.write(buf)
+            else:
+                data = zlib.compress(buf, 1)
+                self._fp.write(self.FRAME.pack(frame_no, len(data)))
+                self._fp.write(data)
+            self._free.put(idx)
+
+    def capture(self, surf: pg.Surface, frame_no: int) -> None:
+        """
+        描画後に毎フレーム呼ぶ。空きバッファが無ければドロップする
+        """
+        self._frame += 1
+        if self._frame % self._every != 0:
+            return
+        try:
+            idx = self._free.get_nowait()
+        except queue.Empty:
+            self._dropped += 1
+            return
+        self._pool[idx][:] = surf.get_buffer()
+        self._work.put_nowait((idx, frame_no))
+        self._captured += 1
+
+    def get_captured(self) -> int:
+        return self._captured
+
+    def get_dropped(self) -> int:
+        return self._dropped
+
+    def close(self) -> None:
+        """
+        残りを書き出して閉じる
+        """
+        self._work.put(None)
+        self._thread.join()
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+        if self._fp is not None:
+            self._fp.close()
+        print(f"capture: {self._captured} frames, {self._dropped} dropped")
+
+
+def read_capture(path: str):
+    """
+    .dgcap を1フレームずつ読み出す。(フレーム番号, HxWx3 の RGB 配列) を yield する
+    """
+    with open(path, "rb") as f:
+        magic, w, h, pitch, bytesize, rm, gm, bm, am, fps = FrameCapture.HEADER.unpack(
+            f.read(FrameCapture.HEADER.size))
+        if magic != FrameCapture.MAGIC:
+            raise ValueError(f"not a capture file: {path}")
+        order = surface_pixel_format((rm, gm, bm, am), bytesize)
+        rgb = [order.index(c) for c in "rgb"]
+        while True:
+            head = f.read(FrameCapture.FRAME.size)
+            if len(head) < FrameCapture.FRAME.size:
+                return
+            frame_no, n = FrameCapture.FRAME.unpack(head)
+            px = np.frombuffer(zlib.decompress(f.read(n)), dtype=np.uint8)
+            px = px.reshape(h, pitch // bytesize, bytesize)[:, :w, rgb]
+            yield frame_no, px
+
+
+# =========================
+# テレメトリ
+# =========================
+class TelemetryLog:
+    """
+    ゲーム中のイベントを固定長のバイナリレコードで記録する。
+
+    - log() は確保済みのリングバッファに struct.pack_into で書くだけ（ファイルI/Oなし）
+    - 別スレッドが一定件数ごと（または一定時間ごと）にまとめてファイルへ書き出す
+    - ファイルが max_bytes を超えたら path.1, path.2 ... へ回して新しいファイルにする
+    - バッファが一杯なら（書き出しが追いつかない）そのイベントは捨てて数える
+    - 作った時点で、前のランの path.1, path.2 ... は消す（別のランと混ざらないように）
+
+    ファイル形式: ヘッダ（magic, 版, レコード長, アイテム名一覧）+ RECORD の繰り返し
+    RECORD: フレーム番号, 種類, コード, x, y, 値
+    """
+    MAGIC = b"DGTL"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHH")
+    RECORD = struct.Struct("<IHHhhf")
+    DTYPE = np.dtype([("frame", "<u4"), ("type", "<u2"), ("code", "<u2"),
+                      ("x", "<i2"), ("y", "<i2"), ("value", "<f4")])
+
+    # 種類（code / value の意味）
+    SPAWN_ENEMY = 1   # code: 0=ground 1=air
+    SPAWN_ITEM = 2    # code: アイテム番号
+    KILL = 3          # code: 0=beam 1=arrow
+    PICKUP = 4        # code: アイテム番号
+    DAMAGE = 5        # code: 0=接触 1=敵弾, value: 残りHP
+    STAGE = 6         # code: ステージ番号
+    FRAME = 7         # value: フレーム時間（ms）
+    TYPE_NAMES = {SPAWN_ENEMY: "spawn_enemy", SPAWN_ITEM: "spawn_item", KILL: "kill",
+                  PICKUP: "pickup", DAMAGE: "damage", STAGE: "stage", FRAME: "frame"}
+
+    def __init__(self, path: str, item_ids: list[str], capacity: int = 8192, batch: int = 1024,
+                 max_bytes: int = 8 * 1024 * 1024, backups: int = 3):
+        self._path = path
+        self._item_ids = list(item_ids)
+        self._item_codes = {item_id: i for i, item_id in enumerate(self._item_ids)}
+        self._cap = capacity
+        self._batch = batch
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._buf = bytearray(capacity * self.RECORD.size)
+        self._head = 0     # 書いた件数（log 側だけが進める）
+        self._tail = 0     # 書き出した件数（書き出しスレッドだけが進める）
+        self._dropped = 0
+        self._lock = threading.Lock()   # log() はどのスレッドから呼んでもよい
+        self._wake = threading.Event()
+        self._stop = False
+        self._fp = None
+        self._remove_backups()
+        self._open()
+        self._thread = threading.Thread(target=self._run, name="TelemetryLog", daemon=True)
+        self._thread.start()
+
+    def item_code(self, item_id: str) -> int:
+        return self._item_codes.get(item_id, 0xFFFF)
+
+    def log(self, kind: int, frame: int, code: int = 0, x: int = 0, y: int = 0, value: float = 0.0) -> None:
+        with self._lock:
+            head = self._head
+            if head - self._tail >= self._cap:
+                self._dropped += 1
+                return
+            self.RECORD.pack_into(self._buf, (head % self._cap) * self.RECORD.size,
+                                  frame, kind, code, x, y, value)
+            self._head = head + 1
+        if head + 1 - self._tail >= self._batch:
+            self._wake.set()
+
+    def get_dropped(self) -> int:
+        return self._dropped
+
+    def _open(self) -> None:
+        names = ",".join(self._item_ids).encode()
+        self._fp = open(self._path, "wb")
+        self._fp.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size, len(names)))
+        self._fp.write(names)
+
+    def _remove_backups(self) -> None:
+        i = 1
+        while os.path.exists(f"{self._path}.{i}") or i <= self._backups:
+            if os.path.exists(f"{self._path}.{i}"):
+                os.remove(f"{self._path}.{i}")
+            i += 1
+
+    def _rotate(self) -> None:
+        self._fp.close()
+        for i in range(self._backups - 1, 0, -1):
+            src = f"{self._path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self._path}.{i + 1}")
+        if self._backups > 0:
+            os.replace(self._path, f"{self._path}.1")
+        self._open()
+
+    def _flush(self) -> None:
+        head = self._head
+        tail = self._tail
+        if head == tail:
+            return
+        size = self.RECORD.size
+        mv = memoryview(self._buf)
+        a = (tail % self._cap) * size
+        b = (head % self._cap) * size
+        if a < b:
+            self._fp.write(mv[a:b])
+        else:
+            self._fp.write(mv[a:])
+            self._fp.write(mv[:b])
+        self._tail = head
+        self._fp.flush()
+        if self._fp.tell() >= self._max_bytes:
+            self._rotate()
+
+    def _run(self) -> None:
+        while not self._stop:
+            self._wake.wait(0.5)
+            self._wake.clear()
+            self._flush()
+
+    def close(self) -> None:
+        self._stop = True
+        self._wake.set()
+        self._thread.join()
+        self._flush()
+        self._fp.close()
+        if self._dropped:
+            print(f"telemetry: {self._dropped} events dropped")
+
+
+def telemetry_files(path: str) -> list[str]:
+    """
+    ローテーション済みも含めたテレメトリファイルを古い順に返す
+    """
+    files = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        files.append(f"{path}.{i}")
+        i += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def iter_telemetry(path: str, chunk_records: int = 65536):
+    """
+    テレメトリファイルを chunk_records 件ずつ読み、(アイテム名一覧, 構造化配列) を yield する。
+    （全体をメモリに載せない）
+    """
+    for fname in telemetry_files(path):
+        with open(fname, "rb") as f:
+            magic, version, rec_size, n_names = TelemetryLog.HEADER.unpack(f.read(TelemetryLog.HEADER.size))
+            if magic != TelemetryLog.MAGIC or rec_size != TelemetryLog.RECORD.size:
+                raise ValueError(f"not a telemetry file: {fname}")
+            names = f.read(n_names).decode().split(",")
+            while True:
+                data = f.read(chunk_records * rec_size)
+                n = len(data) // rec_size
+                if n == 0:
+                    break
+                yield names, np.frombuffer(data, dtype=TelemetryLog.DTYPE, count=n)
+
+
+# =========================
+# 計測値の公開（HTTP）
+# =========================
+class MetricsServer:
+    """
+    動いているゲームの計測値を、ローカルの HTTP（Prometheus のテキスト形式）で公開する。
+
+    - main() は毎フレーム publish() を1回呼ぶだけ。値はタプルにまとめて参照を差し替える（ロック無し）
+    - HTTP はデーモンスレッドで受け、最後に差し替えられたスナップショットだけを読んで返す
+      （GC・画像キャッシュ・スポーン予算の値もスナップショットに入れる）
+    - http.server は使う時だけ import する（起動時間に乗せない）
+    - GC の停止時間は gc.callbacks で測る
+    - spawner を渡すと、スポーン予算で止めた回数も出す
+
+    GET /metrics で取得する（例: curl http://127.0.0.1:9109/metrics）
+    """
+    # フレーム時間ヒストグラムの上限（秒）
+    BUCKETS = (0.004, 0.008, 0.0167, 0.02, 0.025, 0.0333, 0.05, 0.1, 0.25)
+
+    def __init__(self, port: int, host: str = "127.0.0.1", spawner: SpawnController | None = None):
+        self._spawner = spawner
+        # main スレッドだけが書く
+        self._hist = [0] * (len(self.BUCKETS) + 1)
+        self._ft_sum = 0.0
+        self._frames = 0
+        self._fps = 0.0
+        self._fps_t0 = time.perf_counter()
+        self._fps_n = 0
+        self._snapshot = None
+        # GC コールバック（GC を起こしたスレッド）が書く
+        self._gc_t0 = 0.0
+        self._gc_count = [0, 0, 0]
+        self._gc_seconds = [0.0, 0.0, 0.0]
+        self._gc_max = 0.0
+
+        import http.server
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+        # 待ち受けできてから登録する（bind に失敗した時に残らないように）
+        gc.callbacks.append(self._on_gc)
+
+    def get_port(self) -> int:
+        """
+        実際に待ち受けているポート（port=0 で空きポートを使った場合用）
+        """
+        return self._httpd.server_address[1]
+
+    def _on_gc(self, phase: str, info: dict) -> None:
+        if phase == "start":
+            self._gc_t0 = time.perf_counter()
+            return
+        dt = time.perf_counter() - self._gc_t0
+        gen = info["generation"]
+        self._gc_count[gen] += 1
+        self._gc_seconds[gen] += dt
+        if dt > self._gc_max:
+            self._gc_max = dt
+
+    def publish(self, tmr: int, stage: int, frame_sec: float, scene: Scene) -> None:
+        """
+        1フレーム分の値を反映する（main スレッドから毎フレーム）
+        """
+        i = 0
+        for le in self.BUCKETS:
+            if frame_sec <= le:
+                break
+            i += 1
+        self._hist[i] += 1
+        self._ft_sum += frame_sec
+        self._frames += 1
+
+        # FPS は直近約1秒の平均
+        self._fps_n += 1
+        now = time.perf_counter()
+        if now - self._fps_t0 >= 1.0:
+            self._fps = self._fps_n / (now - self._fps_t0)
+            self._fps_t0 = now
+            self._fps_n = 0
+
+        spawn = None
+        if self._spawner is not None:
+            spawn = (self._spawner.get_stats(), self._spawner.get_pending(), self._spawner.get_pressure())
+        self._snapshot = (tmr, stage, self._fps, tuple(self._hist), self._ft_sum, self._frames, scene.counts(),
+                          get_image_cache_stats(), tuple(self._gc_count), tuple(self._gc_seconds), self._gc_max,
+                          spawn)
+
+    def render(self) -> str:
+        """
+        Prometheus テキスト形式の本文
+        """
+        snap = self._snapshot
+        lines = []
+        if snap is None:
+            return ""
+
+        def metric(name: str, kind: str, help_: str, samples: list[tuple[str, float]]) -> None:
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        (tmr, stage, fps, hist, ft_sum, frames, counts,
+         (hit, miss), gc_count, gc_seconds, gc_max, spawn) = snap
+        metric("dungeon_tmr", "gauge", "Current frame counter (tmr).", [("", tmr)])
+        metric("dungeon_stage", "gauge", "Current stage.", [("", stage)])
+        metric("dungeon_fps", "gauge", "Frames per second over the last second.", [("", round(fps, 2))])
+        buckets = []
+        acc = 0
+        for le, n in zip(self.BUCKETS, hist):
+            acc += n
+            buckets.append((f'_bucket{{le="{le}"}}', acc))
+        buckets.append(('_bucket{le="+Inf"}', frames))
+        buckets.append(("_sum", round(ft_sum, 6)))
+        buckets.append(("_count", frames))
+        metric("dungeon_frame_seconds", "histogram", "Frame time.", buckets)
+        metric("dungeon_sprites", "gauge", "Entities per scene layer.",
+               [(f'{{layer="{name}"}}', n) for name, n in counts.items()])
+        metric("dungeon_image_cache_hits_total", "counter", "Image cache hits.", [("", hit)])
+        metric("dungeon_image_cache_misses_total", "counter", "Image cache misses.", [("", miss)])
+        metric("dungeon_image_cache_hit_ratio", "gauge", "Image cache hit ratio.",
+               [("", round(hit / (hit + miss), 4) if hit + miss else 0)])
+        metric("dungeon_gc_collections_total", "counter", "GC collections per generation.",
+               [(f'{{generation="{g}"}}', n) for g, n in enumerate(gc_count)])
+        metric("dungeon_gc_pause_seconds_total", "counter", "Time spent in GC per generation.",
+               [(f'{{generation="{g}"}}', round(sec, 6)) for g, sec in enumerate(gc_seconds)])
+        metric("dungeon_gc_pause_max_seconds", "gauge", "Longest single GC pause.", [("", round(gc_max, 6))])
+        if spawn is not None:
+            stats, pending, pressure = spawn
+            metric("dungeon_spawn_total", "counter", "Spawn requests by group and outcome.",
+                   [(f'{{group="{g}",outcome="{k}"}}', n) for g, st in stats.items() for k, n in st.items()])
+            metric("dungeon_spawn_pending", "gauge", "Deferred spawns waiting for budget.",
+                   [(f'{{group="{g}"}}', n) for g, n in pending.items()])
+            metric("dungeon_spawn_pressure", "gauge", "Frame-time pressure level (0-2).", [("", pressure)])
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+
+# =========================
+# 描画スナップショット
+# =========================
+class RenderState:
+    """
+    1フレーム分の描画内容（シミュレーション結果のスナップショット）。
+
+    シミュレーション（main() の step）が書き、描画（render）が読むだけ。
+    """
+    def __init__(self):
+        self.tmr = 0
+        self.ground_y = 0
+        self.bg_blits: list[tuple[pg.Surface, tuple[int, int]]] = []
+        self.blits: list[tuple[pg.Surface, tuple[int, int]]] = []
+        self.hp = 0
+        self.score = 0
+        self.dmg_popup = False
+        self.attack: str | None = None
+        self.status: str | None = None
+
+
+# =========================
+# メイン
+# =========================
+def main(input_source=None, fps: int = FPS, max_frames: int | None = None, on_frame=None,
+         capture_file: str | None = CAPTURE_FILE,
+         ghost_record_file: str | None = GHOST_RECORD_FILE, ghost_files: list[str] | None = None,
+         track_latency: bool = TRACK_INPUT_LATENCY, low_latency: bool = LOW_LATENCY_INPUT,
+         trace_startup: bool = TRACE_STARTUP,
+         telemetry_file: str | None = TELEMETRY_FILE, metrics_port: int | None = METRICS_PORT,
+         spawner: SpawnController | None = None):
+    """
+    ゲーム本体
+
+    Args:
+        input_source: poll(bird, scene, inv) を持つ入力ソース（None ならキーボード）
+        fps: フレームレート上限（0 なら待たずに回す：ヘッドレス計測用）
+        max_frames: 指定フレーム数で終了する（None なら無制限）
+        on_frame: 毎フレーム末に on_frame(tmr, scene) を呼ぶ（scene は Scene）
+        capture_file: 録画先ファイル（None なら録画しない）
+        ghost_record_file: このランの軌跡（ゴースト）の保存先（None なら保存しない）
+        ghost_files: 一緒に描く過去ランの軌跡ファイル（None なら GHOST_FILES）
+        track_latency: 入力〜表示の遅延を計測し、終了時に分布を表示する
+        low_latency: 入力をシミュレーション直前まで遅らせて読む（LatePoller）
+        trace_startup: 最初のフレーム表示までの時間の内訳を表示する
+        telemetry_file: ゲーム中のイベントを記録するファイル（TelemetryLog）
+        metrics_port: 計測値を HTTP で公開するポート（MetricsServer）
+        spawner: スポーン予算（None なら既定値の SpawnController。終了後に get_stats() で間引き回数を見られる）
+    """
+    trace = StartupTrace(trace_startup)
+    trace.step("main() entry")
+    if input_source is None:
+        input_source = KeyboardInput()
 
     ITEM_DEFS = {
         # 攻撃
@@ -671,6 +2118,33 @@ def main():
         "kinoko": ItemDef("kinoko", "status", "kinoko.png", weight=4, scale=0.1),
         "tabaco": ItemDef("tabaco", "status", "tabaco.png", weight=2, scale=0.03),
     }
+
+    # フレーム0で出る敵（ステージ1）とアイテムの画像は、背景の読み込みなどと並行して裏で作っておく
+    first_sprites = start_prefetch(
+        [], [],
+        [(Enemy.IMG_FILES[(1, kind)], Enemy.SCALE) for kind in ("ground", "air")]
+        + [(d.get_img_file(), d.get_scale()) for d in ITEM_DEFS.values()],
+    )
+
+    pg.display.set_caption("こうかとん横スクロール（ベース）")
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    clock = pg.time.Clock()
+    trace.step("set_mode")
+
+    stage = 1
+    params = stage_params(stage)
+
+    bg = Background(params["bg_file"], params["bg_speed"], trace)
+    bird = Bird(3, (200, get_ground_y()))
+    scene = Scene()
+    scene["player"].add(bird)
+    enemies = scene["enemies"]
+    items = scene["items"]
+    beams = scene["beams"]
+    arrows = scene["arrows"]
+    exps = scene["exps"]
+    bullets = scene["bullets"]  # 敵弾（ボス・中ボスが spawn_* で撃つ）
+
     inv = Inventory(ITEM_DEFS)
 
     UI_ICON_SIZE = 52
@@ -682,11 +2156,10 @@ def main():
         nw, nh = max(1, int(w * s)), max(1, int(h * s))
         return pg.transform.smoothscale(img, (nw, nh))
 
-    UI_ICONS = {item_id: make_ui_icon(item_id) for item_id in ITEM_DEFS.keys()}    
+    # アイコンは初めて表示する時に作る（起動時に全部作らない）
+    UI_ICONS: dict[str, pg.Surface] = {}
+    trace.step("sprites/items")
 
-    # ===== 他の人のアイテムGroupを受け取る場所 =====
-    # 統合するときは、次の1行を「相手が作った items（pg.sprite.Group）」に差し替えるだけでOK
-    items = pg.sprite.Group()
 
     # ===== HP/Score/UI =====
     hp = HP_MAX
@@ -701,6 +2174,7 @@ def main():
 
     font_ui = pg.font.Font(None, 26)
     font_item = pg.font.Font(None, 22)
+    trace.step("fonts")
 
     attack_box = pg.Rect(
         WIDTH - (BOX_W * 2 + BOX_GAP) - BOX_MARGIN,
@@ -754,19 +2228,46 @@ def main():
         body = font_.render(text, True, text_color)
         surf.blit(body, (x, y))
 
-    tmr = 0
-    while True:
-        key_lst = pg.key.get_pressed()
+    if ghost_files is None:
+        ghost_files = GHOST_FILES
+    ghosts = GhostBirds(ghost_files, bird) if ghost_files else None
+    latency = LatencyTracker() if track_latency else None
+    late_poller = LatePoller(fps) if low_latency else None
+    if spawner is None:
+        spawner = SpawnController()
+    # スレッドやファイルを持つものは下の try の中で作る（途中で失敗しても finally で作った分を閉じる）
+    capture: FrameCapture | None = None
+    recorder: GhostRecorder | None = None
+    telemetry: TelemetryLog | None = None
+    metrics: MetricsServer | None = None
+
+    def allow_item() -> bool:
+        return spawner.request("items", scene)
+
+    def read_input() -> tuple:
+        if late_poller is not None:
+            late_poller.wait()
+        inputs = input_source.poll(bird, scene, inv)
+        if latency is not None:
+            latency.polled()
+        return inputs
+
+    def step(tmr: int, key_lst, events: list, rs: RenderState) -> bool:
+        """
+        1フレーム分のシミュレーション。結果を rs に書く。ゲーム終了なら False
+        """
+        nonlocal stage, params, bg, hp, score, dmg_popup_tmr, inv_tmr
 
-        for event in pg.event.get():
+        for event in events:
             if event.type == pg.QUIT:
-                return 0
+                return False
             if event.type == pg.KEYDOWN:
                 if event.key == pg.K_ESCAPE:
-                    return 0
+                    return False
                 if event.key == pg.K_UP:
-                    bird.try_jump()
-                
+                    if bird.try_jump() and latency is not None:
+                        latency.mark("jump", event, tmr)
+
                 if event.key == pg.K_SPACE:
                     atk_id = inv.get_attack()
                     # 何も持ってなければ撃てない
@@ -774,6 +2275,8 @@ def main():
                         beams.add(Beam((bird.get_rect().right + 30, bird.get_rect().centery)))
                     elif atk_id == "arrow":
                         arrows.add(Arrow((bird.get_rect().right + 30, bird.get_rect().centery)))
+                    if atk_id in ("Beam", "arrow") and latency is not None:
+                        latency.mark("fire", event, tmr)
 
         # ステージ切替（全2ステージ）
         if stage == 1 and should_switch_stage(tmr):
@@ -783,62 +2286,79 @@ def main():
             bird.get_rect().bottom = get_ground_y()
             apply_status_from_current(inv, bird)
             enemies.empty()  # ★ステージ1の敵を消して、以後は2の画像だけ出す
+            bullets.clear()
+            spawner.clear_pending()
+            if telemetry is not None:
+                telemetry.log(TelemetryLog.STAGE, tmr, code=stage)
 
-
-
-        # 敵生成：複数流入（変更なし）
+        # 敵生成：複数流入（予算オーバーの分は積んでおき、空いたら出す）
+        spawned = []
         if tmr % params["spawn_interval"] == 0:
-            spawn_enemy(enemies, stage)
-            if random.random() < 0.30:
-                spawn_enemy(enemies, stage)
-
-        maybe_spawn_item(tmr, stage, ITEM_DEFS, items)
-
-        # ===== 描画（速度など変更なし）=====
-        bg.update(screen)
-        if DEBUG_DRAW_GROUND_LINE:
-            pg.draw.line(screen, (0, 0, 0), (0, get_ground_y()), (WIDTH, get_ground_y()), 2)
+            if spawner.request("enemies", scene):
+                spawned.append(spawn_enemy(enemies, stage))
+            if random.random() < 0.30 and spawner.request("enemies", scene):
+                spawned.append(spawn_enemy(enemies, stage))
+        elif spawner.release("enemies", tmr, scene):
+            spawned.append(spawn_enemy(enemies, stage))
+        if telemetry is not None:
+            for emy in spawned:
+                telemetry.log(TelemetryLog.SPAWN_ENEMY, tmr, 0 if emy.get_kind() == "ground" else 1,
+                              *emy.get_rect().center)
+
+        it = maybe_spawn_item(tmr, stage, ITEM_DEFS, items, allow_item)
+        if it is not None and telemetry is not None:
+            telemetry.log(TelemetryLog.SPAWN_ITEM, tmr, telemetry.item_code(it.get_item_id()),
+                          *it.get_rect().center)
 
         # 更新
-        bird.update(key_lst, screen)
-        enemies.update()
-        items.update()
-        beams.update()
-        arrows.update()
-        exps.update()
+        bg.update()
+        scene.update(player=(key_lst,))
+        if recorder is not None:
+            recorder.record(bird)
 
         hit1 = pg.sprite.groupcollide(enemies, beams, True, True) # ビーム当たり判定
         for emy in hit1.keys():
             exps.add(Explosion(emy.get_rect().center, life=30))
             score += random.randint(10,20)  # スコア加算
+            if telemetry is not None:
+                telemetry.log(TelemetryLog.KILL, tmr, 0, *emy.get_rect().center)
 
         hit2 = pg.sprite.groupcollide(enemies, arrows, True, True) # 矢当たり判定
         for emy in hit2.keys():
             exps.add(Explosion(emy.get_rect().center, life=30))
             score += random.randint(10,20)  # スコア加算
+            if telemetry is not None:
+                telemetry.log(TelemetryLog.KILL, tmr, 1, *emy.get_rect().center)
 
         picked = pg.sprite.spritecollide(bird, items, True) # アイテム取得判定
         for it in picked:
             item_id = it.get_item_id()
             cat = ITEM_DEFS[item_id].get_category()
+            if telemetry is not None:
+                telemetry.log(TelemetryLog.PICKUP, tmr, telemetry.item_code(item_id),
+                              *bird.get_rect().center)
 
             if cat == "attack": # 攻撃アイテム
                 inv.pickup_attack(item_id)
             else:
                 apply_status_pickup(item_id, inv, bird)
-        
-        items.update()  # ← 他の人のアイテム（右→左）は相手update内で動く想定
 
         # ===== 敵ダメージ（HP-20）=====
         if inv_tmr > 0:
             inv_tmr -= 1
 
         hit_list = pg.sprite.spritecollide(bird, enemies, False)
-        if hit_list and inv_tmr == 0:
+        # 敵弾の当たり判定はこうかとんの中心付近だけ（弾幕向けの小さめの判定）
+        b_rct = bird.get_rect()
+        shot = bullets.hit(b_rct.inflate(-b_rct.width // 2, -b_rct.height // 2))
+        if (hit_list or shot) and inv_tmr == 0:
             hp = max(0, hp - DMG)
+            if telemetry is not None:
+                telemetry.log(TelemetryLog.DAMAGE, tmr, 0 if hit_list else 1,
+                              *bird.get_rect().center, value=hp)
 
             if hp <= 0:
-                return 0
+                return False
 
             for e in hit_list:
                 e.kill()
@@ -846,23 +2366,80 @@ def main():
             dmg_popup_tmr = POPUP_FRAMES
             inv_tmr = INV_FRAMES
 
-        # 描画（スプライト）
-        items.draw(screen)
-
-
         # HPが0ならゲーム終了（任意）
         if bird.hp <= 0:
-            return 0
+            return False
+
+        # ===== 描画内容を書き出す =====
+        rs.tmr = tmr
+        rs.ground_y = get_ground_y()
+        rs.bg_blits = bg.get_blits()
+        rs.blits.clear()
+        scene.collect_blits(rs.blits)
+        rs.hp = hp
+        rs.score = score
+        # 「-20」赤表示（約2秒）
+        rs.dmg_popup = dmg_popup_tmr > 0
+        if dmg_popup_tmr > 0:
+            dmg_popup_tmr -= 1
+        rs.attack = inv.get_attack()
+        rs.status = inv.get_status()
+        return True
+
+    def draw_slot(box: pg.Rect, item_id: str | None) -> None:
+        # 表示エリア（ラベルの下）
+        pad_x = 12
+        top_y = box.y + 34
+        area = pg.Rect(box.x + pad_x, top_y, box.w - pad_x * 2, box.h - (top_y - box.y) - 10)
+
+        if item_id is None:
+            txt = font_item.render("-", True, (255, 255, 255))
+            screen.blit(txt, (area.x, area.y + 10))
+            return
 
-        enemies.draw(screen)
-        items.draw(screen)
-        beams.draw(screen)
-        arrows.draw(screen)
-        exps.draw(screen)
+        # アイコン
+        icon = UI_ICONS.get(item_id)
+        if icon is None:
+            icon = UI_ICONS[item_id] = make_ui_icon(item_id)
+        icon_y = area.y + (area.h - icon.get_height()) // 2
+        screen.blit(icon, (area.x, icon_y))
+
+        # 名前（長い場合は枠内に収まるように省略）
+        name_x = area.x + icon.get_width() + 10
+        max_w = area.right - name_x
+
+        name_str = item_id
+        txt = font_item.render(name_str, True, (255, 255, 255))
+        if txt.get_width() > max_w:
+            # 末尾を「...」にして収める
+            base = name_str
+            while len(base) > 1:
+                base = base[:-1]
+                name_str = base + "..."
+                txt = font_item.render(name_str, True, (255, 255, 255))
+                if txt.get_width() <= max_w:
+                    break
+
+        name_y = area.y + (area.h - txt.get_height()) // 2
+        screen.blit(txt, (name_x, name_y))
+
+    def render(rs: RenderState) -> None:
+        """
+        RenderState の内容を画面に描く（rs は読むだけ）
+        """
+        # ===== 描画（速度など変更なし）=====
+        screen.blits(rs.bg_blits, False)
+        if DEBUG_DRAW_GROUND_LINE:
+            pg.draw.line(screen, (0, 0, 0), (0, rs.ground_y), (WIDTH, rs.ground_y), 2)
+        if ghosts is not None:
+            ghosts.draw(screen, rs.tmr)
+
+        # 描画（スプライト）
+        screen.blits(rs.blits, False)
 
         # ===== UI：HP（左下）=====
         hp_pos = (20, HEIGHT - 50)
-        hp_text = font.render(f"HP:{hp}", True, (255, 255, 255))
+        hp_text = font.render(f"HP:{rs.hp}", True, (255, 255, 255))
         screen.blit(hp_text, hp_pos)
 
         # HPバー（残りHPを緑）
@@ -870,17 +2447,16 @@ def main():
         bar_w, bar_h = 200, 14
         pg.draw.rect(screen, (0, 0, 0), (bar_x - 2, bar_y - 2, bar_w + 4, bar_h + 4))
         pg.draw.rect(screen, (255, 255, 255), (bar_x, bar_y, bar_w, bar_h))
-        hp_ratio = max(0, min(1, hp / HP_MAX))
+        hp_ratio = max(0, min(1, rs.hp / HP_MAX))
         pg.draw.rect(screen, (0, 200, 0), (bar_x, bar_y, int(bar_w * hp_ratio), bar_h))
 
         # 「-20」赤表示（約2秒）
-        if dmg_popup_tmr > 0:
-            dmg_popup_tmr -= 1
+        if rs.dmg_popup:
             dmg_text = font.render(f"-{DMG}", True, (255, 0, 0))
             screen.blit(dmg_text, (hp_pos[0] + hp_text.get_width() + 10, hp_pos[1]))
 
         # ===== UI：Score（右上：白縁＋中黒）=====
-        score_str = f"Score:{score}"
+        score_str = f"Score:{rs.score}"
         tmp = font.render(score_str, True, (0, 0, 0))  # 幅取得用
         score_pos = (WIDTH - tmp.get_width() - 20, 20)
         draw_text_outline(screen, score_str, font, score_pos, (0, 0, 0), (255, 255, 255), outline_px=2)
@@ -896,57 +2472,93 @@ def main():
         screen.blit(atk_label, (attack_box.x + 10, attack_box.y + 8))
         screen.blit(sta_label, (status_box.x + 10, status_box.y + 8))
 
-        # ---- invから現在装備を取得 ----
-        atk_id = inv.get_attack()
-        sta_id = inv.get_status()
+        # 描画
+        draw_slot(attack_box, rs.attack)
+        draw_slot(status_box, rs.status)
 
-        def draw_slot(box: pg.Rect, item_id: str | None) -> None:
-            # 表示エリア（ラベルの下）
-            pad_x = 12
-            top_y = box.y + 34
-            area = pg.Rect(box.x + pad_x, top_y, box.w - pad_x * 2, box.h - (top_y - box.y) - 10)
+    rs = RenderState()
 
-            if item_id is None:
-                txt = font_item.render("-", True, (255, 255, 255))
-                screen.blit(txt, (area.x, area.y + 10))
-                return
+    first_sprites.join()
+    trace.step("prefetch wait (stage 1)")
 
-            # アイコン
-            icon = UI_ICONS[item_id]
-            icon_y = area.y + (area.h - icon.get_height()) // 2
-            screen.blit(icon, (area.x, icon_y))
-
-            # 名前（長い場合は枠内に収まるように省略）
-            name_x = area.x + icon.get_width() + 10
-            max_w = area.right - name_x
-
-            name_str = item_id
-            txt = font_item.render(name_str, True, (255, 255, 255))
-            if txt.get_width() > max_w:
-                # 末尾を「...」にして収める
-                base = name_str
-                while len(base) > 1:
-                    base = base[:-1]
-                    name_str = base + "..."
-                    txt = font_item.render(name_str, True, (255, 255, 255))
-                    if txt.get_width() <= max_w:
-                        break
-
-            name_y = area.y + (area.h - txt.get_height()) // 2
-            screen.blit(txt, (name_x, name_y))
+    try:
+        capture = FrameCapture(capture_file, screen, fps=FPS) if capture_file else None
+        recorder = GhostRecorder(ghost_record_file) if ghost_record_file else None
+        telemetry = TelemetryLog(telemetry_file, list(ITEM_DEFS.keys())) if telemetry_file else None
+        metrics = MetricsServer(metrics_port, spawner=spawner) if metrics_port is not None else None
 
-        # 描画
-        draw_slot(attack_box, atk_id)
-        draw_slot(status_box, sta_id)
+        tmr = 0
+        frame_t = time.perf_counter()
+        while True:
+            if max_frames is not None and tmr >= max_frames:
+                return 0
+            key_lst, events = read_input()
+            if not step(tmr, key_lst, events, rs):
+                return 0
 
-        pg.display.update()
-        
-        tmr += 1
-        clock.tick(FPS)
+            render(rs)
+
+            if capture is not None:
+                capture.capture(screen, tmr)
+
+            if late_poller is not None:
+                late_poller.before_present()
+            pg.display.update()
+            if late_poller is not None:
+                late_poller.presented()
+            if latency is not None:
+                latency.presented(tmr)
+
+            if tmr == 0:
+                trace.step("first frame")
+                trace.report()
+                # 最初のフレームを出したら、後で使う画像を裏で読んでおく
+                start_prefetch(
+                    [stage_params(2)["bg_file"]],
+                    [d.get_img_file() for d in ITEM_DEFS.values()] + ["explosion.gif"],
+                    [(f, Enemy.SCALE) for f in Enemy.IMG_FILES.values()]
+                    + [(d.get_img_file(), d.get_scale()) for d in ITEM_DEFS.values()],
+                )
+
+            if on_frame is not None:
+                on_frame(tmr, scene)
+
+            tmr += 1
+            # 処理時間（待ちを除く）でスポーン予算を調整する
+            busy_sec = time.perf_counter() - frame_t
+            if late_poller is not None:
+                busy_sec -= late_poller.get_waited()
+            spawner.note_frame(busy_sec)
+            if late_poller is not None:
+                # 待ちは LatePoller が入力の前と表示の前に行う
+                clock.tick()
+            else:
+                clock.tick(fps)
+            now = time.perf_counter()
+            frame_sec = now - frame_t
+            frame_t = now
+            if telemetry is not None:
+                telemetry.log(TelemetryLog.FRAME, tmr - 1, value=frame_sec * 1000)
+            if metrics is not None:
+                metrics.publish(tmr - 1, stage, frame_sec, scene)
+    finally:
+        if capture is not None:
+            capture.close()
+        if recorder is not None:
+            recorder.close()
+        if latency is not None:
+            latency.report()
+        if telemetry is not None:
+            telemetry.close()
+        if metrics is not None:
+            metrics.close()
+
+
+_STARTUP_MARKS.append(("module body", time.perf_counter()))
 
 
 if __name__ == "__main__":
-    pg.init()
+    init_pygame()
     main()
     pg.quit()
     sys.exit()
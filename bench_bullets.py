@@ -0,0 +1,127 @@
+"""
+弾幕ベンチマーク
+
+BulletEngine（NumPy 配列で一括処理）と、弾1発ごとに Sprite を作る素朴な実装で
+同じ弾幕（全方位＋渦巻き＋自機狙い）を回し、1フレームあたりの
+移動・当たり判定・描画の時間を比べる。
+
+使い方:
+    python bench_bullets.py --frames 600
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame as pg
+
+import Dungeon
+
+
+class SpriteBullet(pg.sprite.Sprite):
+    """
+    比較用：弾1発 = Sprite1個
+    """
+    def __init__(self, img: pg.Surface, x: float, y: float, vx: float, vy: float):
+        super().__init__()
+        self.image = img
+        self.rect = img.get_rect(center=(int(x), int(y)))
+        self._x, self._y, self._vx, self._vy = x, y, vx, vy
+
+    def update(self) -> None:
+        self._x += self._vx
+        self._y += self._vy
+        self.rect.center = (int(self._x), int(self._y))
+        if not (-16 < self._x < Dungeon.WIDTH + 16 and -16 < self._y < Dungeon.HEIGHT + 16):
+            self.kill()
+
+
+class SpriteBullets:
+    """
+    比較用：BulletEngine と同じ spawn を Sprite で行う
+    """
+    def __init__(self, img: pg.Surface):
+        self._img = img
+        self._group = pg.sprite.Group()
+
+    def __len__(self) -> int:
+        return len(self._group)
+
+    def _spawn(self, cx, cy, angles, speed):
+        for a in angles:
+            self._group.add(SpriteBullet(self._img, cx, cy, math.cos(a) * speed, math.sin(a) * speed))
+
+    def spawn_radial(self, cx, cy, count, speed, offset_deg=0.0):
+        off = math.radians(offset_deg)
+        self._spawn(cx, cy, [off + i * 2 * math.pi / count for i in range(count)], speed)
+
+    def spawn_aimed(self, cx, cy, target, count, speed, spread_deg=0.0):
+        base = math.atan2(target[1] - cy, target[0] - cx)
+        step = math.radians(spread_deg) / max(1, count - 1)
+        self._spawn(cx, cy, [base - math.radians(spread_deg) / 2 + i * step for i in range(count)], speed)
+
+    def spawn_spiral(self, cx, cy, arms, speed, tmr, turn_deg=7.0):
+        self.spawn_radial(cx, cy, arms, speed, offset_deg=tmr * turn_deg)
+
+    def update(self):
+        self._group.update()
+
+    def hit(self, rect):
+        hits = [b for b in self._group if rect.colliderect(b.rect)]
+        for b in hits:
+            b.kill()
+        return len(hits)
+
+    def draw(self, screen):
+        self._group.draw(screen)
+
+
+def run(engine, screen: pg.Surface, frames: int) -> tuple[float, int]:
+    """
+    弾幕を frames フレーム回し、(1フレーム平均ms, 最大弾数) を返す
+    """
+    boss = (Dungeon.WIDTH - 200, Dungeon.HEIGHT // 3)
+    player = pg.Rect(200, Dungeon.HEIGHT - 160, 30, 30)
+    peak = 0
+    t_total = 0.0
+    for tmr in range(frames):
+        if tmr % 6 == 0:
+            engine.spawn_radial(*boss, 48, 3.0, offset_deg=tmr)
+        if tmr % 10 == 0:
+            engine.spawn_aimed(*boss, player.center, 7, 5.0, spread_deg=40)
+        engine.spawn_spiral(*boss, 6, 2.5, tmr)
+
+        screen.fill((0, 0, 0))
+        t0 = time.perf_counter()
+        engine.update()
+        engine.hit(player)
+        engine.draw(screen)
+        t_total += time.perf_counter() - t0
+        peak = max(peak, len(engine))
+    return t_total / frames * 1000, peak
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="弾幕ベンチマーク")
+    ap.add_argument("--frames", type=int, default=600)
+    args = ap.parse_args()
+
+    Dungeon.init_pygame()
+    screen = pg.display.set_mode((Dungeon.WIDTH, Dungeon.HEIGHT))
+    vec = Dungeon.BulletEngine()
+    ms_vec, peak = run(vec, screen, args.frames)
+    ms_spr, _ = run(SpriteBullets(vec.get_image()), screen, args.frames)
+    pg.quit()
+
+    budget = 1000 / Dungeon.FPS
+    print(f"peak bullets : {peak}")
+    print(f"BulletEngine : {ms_vec:6.2f} ms/frame ({ms_vec / budget * 100:.0f}% of {budget:.1f} ms)")
+    print(f"Sprite/bullet: {ms_spr:6.2f} ms/frame ({ms_spr / budget * 100:.0f}% of {budget:.1f} ms)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
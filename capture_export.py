@@ -0,0 +1,35 @@
+"""
+録画ファイル（.dgcap）を連番PNGに書き出す
+
+使い方:
+    python capture_export.py run.dgcap out_dir
+"""
+import os
+import sys
+
+import pygame as pg
+
+# Dungeon は import 時にリポジトリへ chdir するので、引数の相対パスは先に覚えた場所から解決する
+CWD = os.getcwd()
+
+import Dungeon
+
+
+def main() -> int:
+    if len(sys.argv) != 3:
+        print(__doc__)
+        return 2
+    src = os.path.join(CWD, sys.argv[1])
+    out_dir = os.path.join(CWD, sys.argv[2])
+    os.makedirs(out_dir, exist_ok=True)
+    n = 0
+    for frame_no, px in Dungeon.read_capture(src):
+        surf = pg.surfarray.make_surface(px.swapaxes(0, 1))
+        pg.image.save(surf, os.path.join(out_dir, f"{frame_no:06d}.png"))
+        n += 1
+    print(f"{n} frames -> {out_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+長時間ソークテスト
+
+ゲームをヘッドレス（ダミー画面）でボットに遊ばせ続け、
+一定間隔でメモリ・GC・スプライト数を記録する。
+計測値が右肩上がり（リーク）なら終了コード 1 で失敗する。
+
+使い方:
+    python soak.py --hours 2
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame as pg
+
+import Dungeon
+
+GROUP_NAMES = ("enemies", "items", "beams", "arrows", "exps", "bullets")
+
+
+def unbounded_spawner() -> Dungeon.SpawnController:
+    """
+    上限なしのスポーン予算（リークした敵で予算が埋まり、スポーンが止まってリークが隠れるのを防ぐ）。
+    実時間にも依存させない（同じシードで同じラン）
+    """
+    return Dungeon.SpawnController(budgets={}, global_budget=1 << 30, frame_budget=None)
+
+
+def read_rss() -> int | None:
+    """
+    常駐メモリ（バイト）。/proc が無い環境では None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def slope_growth(xs: list[float], ys: list[float]) -> float:
+    """
+    最小二乗で傾きを求め、区間全体での増加量（傾き×区間長）を返す
+    """
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx == 0:
+        return 0.0
+    sxy = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    return sxy / sxx * (xs[-1] - xs[0])
+
+
+class SoakMonitor:
+    """
+    一定フレームごとにサンプルを取り、最後に傾向を判定する
+    """
+    def __init__(self, interval: int, spawner: Dungeon.SpawnController):
+        self._interval = interval
+        self._spawner = spawner
+        self._frames = 0
+        self._samples: list[dict[str, float]] = []
+
+    def on_frame(self, tmr: int, scene: Dungeon.Scene) -> None:
+        self._frames += 1
+        if self._frames % self._interval != 0:
+            return
+        cur, peak = tracemalloc.get_traced_memory()
+        s = {
+            "frame": self._frames,
+            "traced": cur,
+            "objects": len(gc.get_objects()),
+        }
+        rss = read_rss()
+        if rss is not None:
+            s["rss"] = rss
+        # 世代ごとの GC 実行回数（累計）
+        for gen, st in enumerate(gc.get_stats()):
+            s[f"gc{gen}"] = st["collections"]
+        counts = scene.counts()
+        for name in GROUP_NAMES:
+            s[name] = counts[name]
+        # 上限なしなので本来 0 のまま。増えていたら何かが予算を埋めている
+        s["throttled"] = sum(st["deferred"] + st["thinned"] for st in self._spawner.get_stats().values())
+        self._samples.append(s)
+
+    def get_frames(self) -> int:
+        return self._frames
+
+    def get_samples(self) -> list[dict[str, float]]:
+        return self._samples
+
+    def growth(self, key: str, warmup: float) -> float:
+        """
+        ウォームアップ分を除いたサンプルでの増加傾向
+        """
+        samples = [s for s in self._samples if key in s]
+        samples = samples[int(len(samples) * warmup):]
+        return slope_growth([s["frame"] for s in samples], [s[key] for s in samples])
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="こうかとんダンジョン ソークテスト")
+    ap.add_argument("--hours", type=float, default=1.0, help="シミュレーション時間（60FPS換算）")
+    ap.add_argument("--interval", type=int, default=600, help="サンプリング間隔（フレーム）")
+    ap.add_argument("--warmup", type=float, default=0.1, help="判定から除く先頭サンプルの割合")
+    ap.add_argument("--max-mem-growth-mb", type=float, default=16.0, help="許容するメモリ増加量")
+    ap.add_argument("--max-entity-growth", type=float, default=10.0, help="許容するグループ要素数の増加量")
+    ap.add_argument("--max-object-growth", type=float, default=5000.0, help="許容する GC 管理オブジェクト数の増加量")
+    ap.add_argument("--profile", choices=sorted(Dungeon.BotInput.PROFILES), default="survivor", help="ボットの行動プロファイル")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    random.seed(args.seed)
+    total = int(args.hours * 3600 * Dungeon.FPS)
+    spawner = unbounded_spawner()
+    mon = SoakMonitor(args.interval, spawner)
+    bot = Dungeon.BotInput(args.profile)
+
+    Dungeon.init_pygame()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    runs = 0
+    # 死んだら次のランを始める（ラン間のリークも拾える）
+    while mon.get_frames() < total:
+        runs += 1
+        Dungeon.main(input_source=bot, fps=0, max_frames=total - mon.get_frames(), on_frame=mon.on_frame,
+                     spawner=spawner)
+    elapsed = time.perf_counter() - t0
+    tracemalloc.stop()
+    pg.quit()
+
+    print(f"frames={mon.get_frames()} runs={runs} samples={len(mon.get_samples())} wall={elapsed:.1f}s")
+
+    limits = {"traced": args.max_mem_growth_mb * 1024 * 1024, "rss": args.max_mem_growth_mb * 1024 * 1024,
+              "objects": args.max_object_growth, "throttled": 0.0}
+    for name in GROUP_NAMES:
+        limits[name] = args.max_entity_growth
+
+    failed = []
+    for key in ("traced", "rss", "objects", *GROUP_NAMES, "throttled"):
+        g = mon.growth(key, args.warmup)
+        limit = limits.get(key)
+        status = "-"
+        if limit is not None:
+            status = "NG" if g > limit else "OK"
+            if g > limit:
+                failed.append(key)
+        print(f"  {key:9s} growth={g:14.1f} limit={limit if limit is not None else '-'} {status}")
+
+    # GC の実行回数は増えて当然なので判定せず、頻度だけ出す
+    samples = mon.get_samples()
+    if len(samples) >= 2:
+        span = samples[-1]["frame"] - samples[0]["frame"]
+        rates = ", ".join(f"gen{g}={(samples[-1][f'gc{g}'] - samples[0][f'gc{g}']) / span * 3600:.1f}"
+                          for g in range(3))
+        print(f"  gc collections per 3600 frames: {rates}")
+
+    stats = spawner.get_stats()
+    print("  spawns: " + ", ".join(f"{g}={st['spawned']}" for g, st in stats.items()))
+
+    if failed:
+        print(f"FAIL: {', '.join(failed)}")
+        return 1
+    print("PASS")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+テレメトリ（TelemetryLog の出力）の集計
+
+ファイルを少しずつ読みながら集計するので、長時間ランの大きなログでも
+メモリを食わない。ローテーション済み（path.1, path.2 ...）もまとめて読む。
+
+使い方:
+    python telemetry_stats.py run.dgtl
+"""
+import os
+import sys
+
+import numpy as np
+
+# Dungeon は import 時にリポジトリへ chdir するので、引数の相対パスは先に覚えた場所から解決する
+CWD = os.getcwd()
+
+import Dungeon
+
+T = Dungeon.TelemetryLog
+
+# フレーム時間のヒストグラム（0.1ms刻み・200msまで、それ以上は最後のビン）
+BIN_MS = 0.1
+N_BINS = 2000
+
+
+def percentile_from_hist(hist: np.ndarray, q: float) -> float:
+    total = hist.sum()
+    if total == 0:
+        return 0.0
+    idx = int(np.searchsorted(np.cumsum(hist), q / 100 * total))
+    return (idx + 0.5) * BIN_MS
+
+
+def main() -> int:
+    if len(sys.argv) != 2:
+        print(__doc__)
+        return 2
+    path = os.path.join(CWD, sys.argv[1])
+    if not Dungeon.telemetry_files(path):
+        print(f"telemetry file not found: {path}", file=sys.stderr)
+        return 1
+
+    type_counts = np.zeros(65536, dtype=np.int64)
+    spawn_kind = np.zeros(2, dtype=np.int64)
+    kills = np.zeros(2, dtype=np.int64)
+    damage = np.zeros(2, dtype=np.int64)
+    item_spawns: dict[int, int] = {}
+    pickups: dict[int, int] = {}
+    stages: list[tuple[int, int]] = []
+    hist = np.zeros(N_BINS, dtype=np.int64)
+    ft_sum = 0.0
+    ft_max = 0.0
+    last_frame = 0
+    n_records = 0
+    names: list[str] = []
+
+    for names, rec in Dungeon.iter_telemetry(path):
+        t = rec["type"]
+        type_counts += np.bincount(t, minlength=65536)
+        last_frame = max(last_frame, int(rec["frame"].max()))
+        n_records += len(rec)
+
+        sel = rec[t == T.SPAWN_ENEMY]
+        spawn_kind += np.bincount(sel["code"], minlength=2)[:2]
+        sel = rec[t == T.KILL]
+        kills += np.bincount(sel["code"], minlength=2)[:2]
+        sel = rec[t == T.DAMAGE]
+        damage += np.bincount(sel["code"], minlength=2)[:2]
+        for kind, table in ((T.SPAWN_ITEM, item_spawns), (T.PICKUP, pickups)):
+            codes, cnts = np.unique(rec[t == kind]["code"], return_counts=True)
+            for c, n in zip(codes.tolist(), cnts.tolist()):
+                table[c] = table.get(c, 0) + n
+        for r in rec[t == T.STAGE]:
+            stages.append((int(r["frame"]), int(r["code"])))
+
+        ft = rec[t == T.FRAME]["value"].astype(np.float64)
+        if len(ft):
+            ft_sum += ft.sum()
+            ft_max = max(ft_max, float(ft.max()))
+            hist += np.bincount(np.minimum((ft / BIN_MS).astype(np.int64), N_BINS - 1), minlength=N_BINS)
+
+    def item_name(code: int) -> str:
+        return names[code] if code < len(names) else f"#{code}"
+
+    if n_records == 0:
+        print(f"no records in {path}", file=sys.stderr)
+        return 1
+
+    print(f"records: {n_records}  frames: {last_frame + 1}")
+    for kind, name in T.TYPE_NAMES.items():
+        print(f"  {name:12s} {type_counts[kind]}")
+    print(f"enemy spawns: ground={spawn_kind[0]} air={spawn_kind[1]}")
+    print(f"kills: beam={kills[0]} arrow={kills[1]}")
+    print(f"damage: contact={damage[0]} bullet={damage[1]}")
+    print("item spawns: " + ", ".join(f"{item_name(c)}={n}" for c, n in sorted(item_spawns.items())))
+    print("pickups: " + ", ".join(f"{item_name(c)}={n}" for c, n in sorted(pickups.items())))
+    print("stage switches: " + ", ".join(f"stage {st} @ frame {fr}" for fr, st in stages))
+    n_ft = int(hist.sum())
+    if n_ft:
+        print(f"frame time: n={n_ft} mean={ft_sum / n_ft:.2f}ms p50={percentile_from_hist(hist, 50):.1f} "
+              f"p95={percentile_from_hist(hist, 95):.1f} p99={percentile_from_hist(hist, 99):.1f} max={ft_max:.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())